@@ -1,222 +1,522 @@
+import argparse
 import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import math
-
-# Define thermal comfort parameters
-AIR_SPEED = 0.1  # m/s
-CLOTHING_LEVEL = 0.6  # clo
-METABOLIC_RATE = 1.0  # met
-EXTERNAL_WORK = 0  # met
-
-def calculate_pmv(ta, tr, vel, rh, met, clo, wme):
-    pa = rh * 10 * math.exp(16.6536 - 4030.183 / (ta + 235))
-    icl = 0.155 * clo
-    m = met * 58.15
-    w = wme * 58.15
-    mw = m - w
-    fcl = 1.05 + 0.645 * icl
-    hcf = 12.1 * math.sqrt(vel)
-    taa = ta + 273
-    tra = tr + 273
-    tcla = taa + (35.5 - ta) / (3.5 * icl + 0.1)
-    p1 = icl * fcl
-    p2 = p1 * 3.96
-    p3 = p1 * 100
-    p4 = p1 * taa
-    p5 = 308.7 - 0.028 * mw + p2 * (tra / 100.0) ** 4
-    xn = tcla / 100
-    xf = tcla / 50
-    eps = 0.00015
-    n = 0
-    while abs(xn - xf) > eps:
-        xf = (xf + xn) / 2
-        hcn = 2.38 * abs(100.0 * xf - taa) ** 0.25
-        if hcf > hcn:
-            hc = hcf
-        else:
-            hc = hcn
-        xn = (p5 + p4 * hc - p2 * math.pow(xf, 4)) / (100 + p3 * hc)
-        n += 1
-        if n > 150:
-            return 1000
-    tcl = 100 * xn - 273
-    hl1 = 3.05 * 0.001 * (5733 - 6.99 * mw - pa)
-    hl2 = 0.42 * (mw - 58.15)
-    hl3 = 1.7 * 0.00001 * m * (5867 - pa)
-    hl4 = 0.0014 * m * (34 - ta)
-    hl5 = 3.96 * fcl * (math.pow(xn, 4) - math.pow(tra / 100.0, 4))
-    hl6 = fcl * hc * (tcl - ta)
-    ts = 0.303 * math.exp(-0.036 * m) + 0.028
-    pmv = ts * (mw - hl1 - hl2 - hl3 - hl4 - hl5 - hl6)
-    return pmv
-
-def calculate_ppd(pmv):
-    return 100.0 - 95.0 * math.exp(-0.03353 * pow(pmv, 4.0) - 0.2179 * pow(pmv, 2.0))
-
-def calculate_ppd_from_temp_rh(temperature, relative_humidity, air_speed, clothing_level, metabolic_rate, external_work):
-    pmv = calculate_pmv(temperature, temperature, air_speed, relative_humidity, metabolic_rate, clothing_level, external_work)
-    ppd = calculate_ppd(pmv)
-    return ppd
+import xlsxwriter
+from comfort import add_diagnostics_argument, comfort_params, print_solver_diagnostics
+from comfort_cache import add_comfort_columns, comfort_series, frame_comfort
+from manifest import MANIFEST_FILE, is_up_to_date, load_manifest, record, save_manifest
+from run_report import measure, measured_call, run_settings, worker_result
+from sensor_stats import CO2_THRESHOLDS, GROUPINGS, PPD_THRESHOLDS, STAT_COLUMNS, grouped_stats, stat_columns, window_stats
+from series_store import list_sensors, load_series, read_ladybug_file, series_paths
+from study_windows import add_period_arguments, add_window_arguments, window_columns, window_params, window_table, windows_from_args
 
-def process_data(temp_file, humidity_file, co2_file):
-    temp_data = pd.read_csv(temp_file, header=None, names=['temperature'])
-    humidity_data = pd.read_csv(humidity_file, header=None, names=['humidity'])
-    co2_data = pd.read_csv(co2_file, header=None, names=['co2'])
+# Default study period of the statistics, see --start-date and --end-date
+START_DATE = '2024-04-25'
+END_DATE = '2024-06-09'
+
+# Hours of the day reported on the 'Hourly Averages' sheet
+REPORT_HOURS = [0, 6, 12, 18]
+
+# Sheet names of the tables per hour of day, day and week
+GROUPING_SHEETS = {'hour': 'Hour of Day', 'day': 'Daily', 'week': 'Weekly'}
+
+# Formats of the optional sidecar copies of the workbook sheets
+SIDECAR_FORMATS = ['csv', 'parquet']
+
+# Results of every sensor, so a run only analyses the sensors whose inputs changed
+RESULT_CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'analysis')
 
-    date_range = pd.date_range(start='2024-01-01', periods=8760, freq='H')
+def process_data(temp_file, humidity_file, co2_file):
     df = pd.DataFrame({
-        'temperature': temp_data['temperature'].values,
-        'humidity': humidity_data['humidity'].values,
-        'co2': co2_data['co2'].values
-    }, index=date_range)
+        'temperature': read_ladybug_file(temp_file),
+        'humidity': read_ladybug_file(humidity_file),
+        'co2': read_ladybug_file(co2_file)
+    })
 
-    df['ppd'] = df.apply(lambda row: calculate_ppd_from_temp_rh(
-        row['temperature'], row['humidity'], AIR_SPEED, CLOTHING_LEVEL, METABOLIC_RATE, EXTERNAL_WORK
-    ), axis=1)
+    add_comfort_columns(df, comfort_series(df['temperature'].values, df['humidity'].values))
 
     return df
 
-def analyze_data(df, start_date, end_date):
-    df_filtered = df[start_date:end_date]
-    
-    stats = {
-        'temperature_mean': df_filtered['temperature'].mean(),
-        'humidity_mean': df_filtered['humidity'].mean(),
-        'co2_mean': df_filtered['co2'].mean(),
-        'ppd_mean': df_filtered['ppd'].mean(),
-        'comfort_percentage_20': (df_filtered['ppd'] <= 20).mean() * 100,
-        'comfort_percentage_50': (df_filtered['ppd'] <= 50).mean() * 100,
-        'high_co2_percentage': (df_filtered['co2'] > 700).mean() * 100
-    }
-    
-def calculate_hourly_averages(df):
-    hours = [0, 6, 12, 18]
-    averages = {}
-    for hour in hours:
-        hour_data = df[df.index.hour == hour]
-        averages[hour] = {
-            'ppd': hour_data['ppd'].mean(),
-            'temperature': hour_data['temperature'].mean()
-        }
-    return averages
+def load_store_data(store_folder, sensor_name):
+    df = load_series(store_folder, sensor_name)
+    if 'ppd' not in df:
+        add_comfort_columns(df, comfort_series(df['temperature'].values, df['humidity'].values))
+    return df
 
-def analyze_data(df, start_date, end_date):
+def analyze_data(df, start_date, end_date, ppd_thresholds=PPD_THRESHOLDS, co2_thresholds=CO2_THRESHOLDS):
+    # Statistics of the whole window, plus tables per hour of day, day and week
     try:
         df_filtered = df[start_date:end_date]
         
         if df_filtered.empty:
             print(f"No data found between {start_date} and {end_date}")
-            return None
-
-        stats = {
-            'temperature': df_filtered['temperature'].describe(),
-            'humidity': df_filtered['humidity'].describe(),
-            'co2': df_filtered['co2'].describe(),
-            'ppd': df_filtered['ppd'].describe(),
-            'comfort_percentage_20': (df_filtered['ppd'] <= 20).mean() * 100,
-            'comfort_percentage_50': (df_filtered['ppd'] <= 50).mean() * 100,
-            'high_co2_percentage': (df_filtered['co2'] > 700).mean() * 100,
-            'high_co2_percentage_530': (df_filtered['co2'] > 530).mean() * 100
-        }
+            return None, None
+
+        # Percentages only count hours with data; filled_percentage and missing_percentage
+        # report how many hours were filled or missing
+        thresholds = {'ppd_thresholds': ppd_thresholds, 'co2_thresholds': co2_thresholds}
+        stats = window_stats(df_filtered, **thresholds).to_dict()
+        tables = {by: grouped_stats(df_filtered, by, **thresholds) for by in GROUPINGS}
 
-        # Calculate averages for specific hours
-        hours = [0, 6, 12, 18]
-        for hour in hours:
-            hour_data = df_filtered[df_filtered.index.hour == hour]
-            stats[f'ppd_{hour:02d}'] = hour_data['ppd'].mean()
-            stats[f'temperature_{hour:02d}'] = hour_data['temperature'].mean()
+        # Averages for specific hours
+        for hour in REPORT_HOURS:
+            stats[f'ppd_{hour:02d}'] = tables['hour']['ppd_mean'].get(hour, np.nan)
+            stats[f'temperature_{hour:02d}'] = tables['hour']['temperature_mean'].get(hour, np.nan)
         
-        return stats
+        return stats, tables
     except Exception as e:
         print(f"Error in analyze_data: {str(e)}")
-        return None
+        return None, None
+
+def calculate_hourly_averages(hour_table):
+    averages = {}
+    for hour in REPORT_HOURS:
+        averages[hour] = {
+            'ppd': hour_table['ppd_mean'].get(hour, np.nan),
+            'temperature': hour_table['temperature_mean'].get(hour, np.nan)
+        }
+    return averages
+
+def load_sensor(sensor_name, files, input_folder, store_folder):
+    # Hourly data of one sensor from the series store, or from its Ladybug files
+    if files is None:
+        return load_store_data(store_folder, sensor_name)
+    return process_data(
+        os.path.join(input_folder, files['temperature']),
+        os.path.join(input_folder, files['humidity']),
+        os.path.join(input_folder, files['co2'])
+    )
+
+def analyze_sensor(sensor_name, files, input_folder, store_folder, start_date, end_date, ppd_thresholds, co2_thresholds,
+                   pmv_diagnostics=False):
+    # Load and analyse one sensor; runs in a worker process when --jobs > 1
+    with measure('load', sensor_name) as timing:
+        df = load_sensor(sensor_name, files, input_folder, store_folder)
+        timing['rows'] = len(df)
+
+    print(f"Data range for {sensor_name}: {df.index.min()} to {df.index.max()}")
+    if pmv_diagnostics:
+        print_solver_diagnostics(sensor_name, frame_comfort(df), df.index)
+
+    with measure('analyze', sensor_name, len(df)):
+        return analyze_data(df, start_date, end_date, ppd_thresholds, co2_thresholds)
+
+def window_sensor(sensor_name, files, input_folder, store_folder, windows, ppd_thresholds, co2_thresholds):
+    # Load one sensor once and compute the statistics of every study window
+    with measure('load', sensor_name) as timing:
+        df = load_sensor(sensor_name, files, input_folder, store_folder)
+        timing['rows'] = len(df)
+    with measure('windows', sensor_name, len(df)):
+        return window_table(df, windows, ppd_thresholds=ppd_thresholds, co2_thresholds=co2_thresholds)
+
+def sensor_results(sensors, jobs, task, *args):
+    # Yield (sensor, result or exception) of task in sensor order. With jobs > 1 the
+    # sensors are processed in worker processes, with at most two sensors per worker in
+    # flight, so finished results never pile up in memory.
+    if jobs <= 1:
+        for sensor_name, files in sensors:
+            try:
+                yield sensor_name, task(sensor_name, files, *args)
+            except Exception as e:
+                yield sensor_name, e
+        return
+
+    # The timings the workers record are passed back with their results
+    settings = run_settings()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = deque()
+        sensors = iter(sensors)
+        for sensor_name, files in sensors:
+            pending.append((sensor_name, executor.submit(measured_call, settings, task, sensor_name, files, *args)))
+            if len(pending) >= 2 * jobs:
+                break
+        while pending:
+            sensor_name, future = pending.popleft()
+            try:
+                result = worker_result(future.result())
+                yield sensor_name, result
+            except Exception as e:
+                yield sensor_name, e
+            for next_name, files in sensors:
+                pending.append((next_name, executor.submit(measured_call, settings, task, next_name, files, *args)))
+                break
+
+def result_file(sensor_name, cache_folder=RESULT_CACHE_FOLDER):
+    return os.path.join(cache_folder, f'{sensor_name}.pkl')
+
+def cached_sensor_results(sensors, sensor_inputs, params, manifest, jobs, force, *args):
+    # Yield (sensor, result or exception) like sensor_results, loading the result of
+    # every sensor whose inputs and parameters match its manifest entry and analysing
+    # only the others. New results are stored and recorded in the manifest.
+    stale = []
+    for sensor_name, files in sensors:
+        if force or not is_up_to_date(manifest, result_file(sensor_name), sensor_inputs[sensor_name], params):
+            stale.append((sensor_name, files))
+    if len(stale) < len(sensors):
+        print(f"Reusing the results of {len(sensors) - len(stale)} unchanged sensors, analysing {len(stale)}")
+    stale_names = {sensor_name for sensor_name, _ in stale}
+    computed = sensor_results(stale, jobs, analyze_sensor, *args)
+
+    for sensor_name, files in sensors:
+        if sensor_name in stale_names:
+            result = next(computed)[1]
+        else:
+            try:
+                yield sensor_name, pd.read_pickle(result_file(sensor_name))
+                continue
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass
+            # An unreadable result is analysed again
+            try:
+                result = analyze_sensor(sensor_name, files, *args)
+            except Exception as e:
+                result = e
+        if not isinstance(result, Exception) and result[0] is not None:
+            os.makedirs(RESULT_CACHE_FOLDER, exist_ok=True)
+            pd.to_pickle(result, result_file(sensor_name))
+            record(manifest, result_file(sensor_name), sensor_inputs[sensor_name], params)
+        yield sensor_name, result
+
+def fleet_arrays(sensors, input_folder, store_folder, start_date, end_date, columns=STAT_COLUMNS):
+    # One (sensors, hours) array per column over every hour of the window; hours a
+    # sensor has no data for stay NaN
+    hours = pd.date_range(start=start_date, end=pd.Timestamp(end_date) + pd.Timedelta(hours=23), freq='H')
+    arrays = {column: np.full((len(sensors), len(hours)), np.nan) for column in columns}
+    for i, (sensor_name, files) in enumerate(sensors):
+        try:
+            df = load_sensor(sensor_name, files, input_folder, store_folder)
+        except Exception as e:
+            print(f"Error loading data for sensor {sensor_name}: {str(e)}")
+            continue
+        df = df[~df.index.duplicated()].reindex(hours)
+        for column in columns:
+            if column in df:
+                arrays[column][i] = df[column].to_numpy(dtype=float)
+    return arrays
+
+def fleet_similarity(sensor_names, arrays):
+    # Correlation and distance tables of every pair of sensors per column, with the
+    # sensors in the order of the correlation clustering of that column
+    from sensor_similarity import cluster_order, correlation_matrix, distance_matrix
+    tables = {}
+    orders = {}
+    for column, data in arrays.items():
+        correlation = correlation_matrix(data)
+        distance = distance_matrix(data)
+        order = cluster_order(correlation)
+        names = [sensor_names[i] for i in order]
+        tables[f'{column} correlation'] = pd.DataFrame(correlation[np.ix_(order, order)], index=names, columns=names)
+        tables[f'{column} distance'] = pd.DataFrame(distance[np.ix_(order, order)], index=names, columns=names)
+        orders[column] = names
+    tables['Cluster Order'] = pd.DataFrame(orders, index=pd.RangeIndex(1, len(sensor_names) + 1, name='position'))
+    return tables
+
+def write_row(worksheet, row, values, date_format):
+    # Write one row; NaN and None stay blank. Numbers skip xlsxwriter's type dispatch,
+    # which is most of the time spent on large sheets.
+    for col, value in enumerate(values):
+        if isinstance(value, float):
+            if not np.isnan(value):
+                worksheet.write_number(row, col, value)
+        elif isinstance(value, pd.Timestamp):
+            worksheet.write_datetime(row, col, value.to_pydatetime(), date_format)
+        elif value is not None:
+            worksheet.write(row, col, value)
+
+def table_rows(sensor_name, table, columns):
+    # Rows of a grouped statistics table as plain Python values under the given columns
+    values = table.reindex(columns=columns).to_numpy(dtype=float).tolist()
+    labels = [label if isinstance(label, pd.Timestamp) else int(label) for label in table.index]
+    return [[sensor_name, label] + row for label, row in zip(labels, values)]
+
+def sidecar_path(output_folder, name, sidecar_format):
+    return os.path.join(output_folder, f'all_sensors_statistics_{name}.{sidecar_format}')
+
+def append_sidecar(path, frame, sidecar_format, parquet_writers):
+    # Append the rows of one sensor to a CSV or Parquet sidecar file
+    if sidecar_format == 'csv':
+        frame.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    if path not in parquet_writers:
+        parquet_writers[path] = pq.ParquetWriter(path, table.schema)
+    parquet_writers[path].write_table(table.cast(parquet_writers[path].schema))
+
+def fleet_comparison(sensors, inputs, input_folder, store_folder, output_folder, start_date, end_date,
+                     manifest, manifest_path, force=False):
+    # Compare every sensor with every other one in a separate workbook
+    excel_file = os.path.join(output_folder, 'fleet_similarity.xlsx')
+    params = {'stage': 'fleet', 'start_date': start_date, 'end_date': end_date, 'comfort': comfort_params()}
+    if not force and is_up_to_date(manifest, [excel_file], inputs, params):
+        print(f"Excel file is up to date: {excel_file}")
+        return
+    if len(sensors) < 2:
+        print("Error: The fleet comparison needs at least two sensors.")
+        return
+
+    sensor_names = [sensor_name for sensor_name, _ in sensors]
+    arrays = fleet_arrays(sensors, input_folder, store_folder, start_date, end_date)
+    tables = fleet_similarity(sensor_names, arrays)
+    with pd.ExcelWriter(excel_file, engine='xlsxwriter') as writer:
+        for sheet_name, table in tables.items():
+            table.to_excel(writer, sheet_name=sheet_name)
+
+    record(manifest, [excel_file], inputs, params)
+    save_manifest(manifest, manifest_path)
+    print(f"Excel file with the similarity of all sensors has been saved: {excel_file}")
+
+def window_comparison(sensors, inputs, input_folder, store_folder, output_folder, windows, thresholds,
+                      manifest, manifest_path, jobs=1, sidecar=None, force=False):
+    # Statistics of every sensor in every study window, one row per sensor and window
+    excel_file = os.path.join(output_folder, 'window_statistics.xlsx')
+    outputs = [excel_file]
+    if sidecar:
+        outputs.append(os.path.join(output_folder, f'window_statistics.{sidecar}'))
+    params = {'stage': 'windows', 'windows': window_params(windows), 'comfort': comfort_params(), 'sidecar': sidecar}
+    params.update(thresholds)
+    if not force and is_up_to_date(manifest, outputs, inputs, params):
+        print(f"Excel file is up to date: {excel_file}")
+        return
+
+    for path in outputs[1:]:
+        if os.path.exists(path):
+            os.remove(path)
+    parquet_writers = {}
+
+    header = ['sensor'] + window_columns(**thresholds)
+    workbook = xlsxwriter.Workbook(excel_file, {'constant_memory': True})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+    worksheet = workbook.add_worksheet('Window Statistics')
+    write_row(worksheet, 0, header, date_format)
+    row = 1
+
+    window_args = (input_folder, store_folder, windows, thresholds['ppd_thresholds'], thresholds['co2_thresholds'])
+    for sensor_name, result in sensor_results(sensors, jobs, window_sensor, *window_args):
+        if isinstance(result, Exception):
+            print(f"Error processing data for sensor {sensor_name}: {str(result)}")
+            continue
+        frame = result.reindex(columns=header[1:])
+        frame.insert(0, 'sensor', sensor_name)
+        for values in frame.astype(object).values.tolist():
+            write_row(worksheet, row, values, date_format)
+            row += 1
+        if sidecar:
+            append_sidecar(outputs[1], frame, sidecar, parquet_writers)
+        print(f"{sensor_name}: {len(windows)} windows")
+
+    workbook.close()
+    for parquet_writer in parquet_writers.values():
+        parquet_writer.close()
+    if row == 1:
+        os.remove(excel_file)
+        print("No valid data to create Excel file.")
+        return
+
+    record(manifest, outputs, inputs, params)
+    save_manifest(manifest, manifest_path)
+    print(f"Excel file with the statistics of {len(windows)} study windows has been saved: {excel_file}")
+
+def write_statistics_workbook(excel_file, results, thresholds, output_folder, sidecar=None):
+    # Write the statistics workbook from (sensor, result) pairs, where result is the
+    # return value of analyze_data or the exception of a failed sensor. Returns the
+    # number of sensors written; without any the workbook is removed again.
+    #
+    # Every sheet has a fixed header, so each sensor's rows can be written as soon as
+    # its results arrive. In constant memory mode xlsxwriter flushes every finished row
+    # to disk, so the workbook never holds more than the current row of each sheet.
+    columns = stat_columns(**thresholds)
+    overall_columns = columns + [f'{name}_{hour:02d}' for hour in REPORT_HOURS for name in ['ppd', 'temperature']]
+    headers = {'overall': ['sensor'] + overall_columns}
+    headers.update({by: ['sensor', by] + columns for by in GROUPINGS})
+
+    if sidecar:
+        for name in list(headers) + ['hourly_averages']:
+            if os.path.exists(sidecar_path(output_folder, name, sidecar)):
+                os.remove(sidecar_path(output_folder, name, sidecar))
+    parquet_writers = {}
+
+    workbook = xlsxwriter.Workbook(excel_file, {'constant_memory': True})
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd'})
+    worksheets = {'overall': workbook.add_worksheet('Overall Statistics')}
+    hourly_sheet = workbook.add_worksheet('Hourly Averages')
+    worksheets.update({by: workbook.add_worksheet(GROUPING_SHEETS[by]) for by in GROUPINGS})
+    rows = {}
+    for name, worksheet in worksheets.items():
+        write_row(worksheet, 0, headers[name], date_format)
+        rows[name] = 1
+
+    all_hourly_averages = {}
+    for sensor_name, result in results:
+        if isinstance(result, Exception):
+            print(f"Error processing data for sensor {sensor_name}: {str(result)}")
+            continue
+        stats, tables = result
+        if stats is None:
+            print(f"Error: Failed to analyze data for sensor {sensor_name}")
+            continue
+
+        print(f"\nStatistics for {sensor_name}:")
+        for key, value in stats.items():
+            if isinstance(value, float):
+                print(f"{key}: {value:.2f}")
+            else:
+                print(f"{key}:\n{value}")
+
+        sheet_rows = {'overall': [[sensor_name] + [float(stats.get(c, np.nan)) for c in overall_columns]]}
+        sheet_rows.update({by: table_rows(sensor_name, table, columns) for by, table in tables.items()})
+        with measure('workbook_rows', sensor_name, sum(len(new_rows) for new_rows in sheet_rows.values())):
+            for name, new_rows in sheet_rows.items():
+                for values in new_rows:
+                    write_row(worksheets[name], rows[name], values, date_format)
+                    rows[name] += 1
+                if sidecar:
+                    frame = pd.DataFrame(new_rows, columns=headers[name])
+                    append_sidecar(sidecar_path(output_folder, name, sidecar), frame, sidecar, parquet_writers)
+
+        all_hourly_averages[sensor_name] = calculate_hourly_averages(tables['hour'])
+
+    if not all_hourly_averages:
+        workbook.close()
+        os.remove(excel_file)
+        return 0
+
+    # Hourly averages, one column per sensor and measure; only four rows, written last
+    hour_labels = [f'{hour:02d}:00' for hour in REPORT_HOURS]
+    hourly_data = pd.DataFrame({
+        f'{sensor} {label}': [f"{averages[hour][key]:.2f}{unit}" for hour in REPORT_HOURS]
+        for sensor, averages in all_hourly_averages.items()
+        for label, key, unit in [('PPD', 'ppd', '%'), ('Temperature', 'temperature', '°C')]
+    }, index=hour_labels)
+    write_row(hourly_sheet, 0, [''] + list(hourly_data.columns), date_format)
+    for row, (label, values) in enumerate(hourly_data.iterrows(), start=1):
+        write_row(hourly_sheet, row, [label] + list(values), date_format)
+    if sidecar:
+        append_sidecar(sidecar_path(output_folder, 'hourly_averages', sidecar), hourly_data.rename_axis('hour').reset_index(),
+                       sidecar, parquet_writers)
+
+    with measure('workbook_close'):
+        workbook.close()
+        for parquet_writer in parquet_writers.values():
+            parquet_writer.close()
+    return len(all_hourly_averages)
 
 def main():
+    parser = argparse.ArgumentParser(description='Create an Excel workbook comparing the statistics of all sensors.')
+    parser.add_argument('--ppd-thresholds', type=float, nargs='+', default=PPD_THRESHOLDS, help='Report the percentage of hours with PPD at or below each value')
+    parser.add_argument('--co2-thresholds', type=float, nargs='+', default=CO2_THRESHOLDS, help='Report the percentage of hours with CO2 above each value (ppm)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes used to analyse the sensors')
+    parser.add_argument('--sidecar', choices=SIDECAR_FORMATS, help='Also write every sheet as a CSV or Parquet file')
+    add_period_arguments(parser, START_DATE, END_DATE)
+    add_window_arguments(parser)
+    parser.add_argument('--fleet', action='store_true', help='Write correlation and distance matrices of all sensor pairs instead of the statistics')
+    parser.add_argument('--force', action='store_true', help='Rebuild the workbook, even if no input has changed')
+    add_diagnostics_argument(parser)
+    args = parser.parse_args()
+
+    if args.sidecar == 'parquet':
+        try:
+            import pyarrow
+        except ImportError:
+            print("Error: Parquet sidecar files need the 'pyarrow' package.")
+            return
+
     script_dir = os.path.dirname(os.path.abspath(__file__))
     input_folder = os.path.join(script_dir, 'analysis_data')
+    store_folder = os.path.join(script_dir, 'output_store')
     output_folder = os.path.join(script_dir, 'output')
     os.makedirs(output_folder, exist_ok=True)
 
-    if not os.path.exists(input_folder):
+    store_sensors = list_sensors(store_folder, 'temperature')
+    if not os.path.exists(input_folder) and not store_sensors:
         print(f"Error: Input folder '{input_folder}' does not exist.")
         return
 
     # Group files by sensor
-    sensor_files = {}
-    for file in os.listdir(input_folder):
+    sensor_files = {sensor_name: None for sensor_name in store_sensors}
+    for file in os.listdir(input_folder) if os.path.exists(input_folder) else []:
         if file.endswith('_ladybug.txt'):
             parts = file.split('_')
             sensor_name = '_'.join(parts[:-3])  # Group by everything before the date
             data_type = parts[-2]  # co2, humidity, or temperature
             
+            if sensor_name in store_sensors:
+                continue
             if sensor_name not in sensor_files:
                 sensor_files[sensor_name] = {}
             
             sensor_files[sensor_name][data_type] = file
 
-    all_stats = {}
-    all_hourly_averages = {}
+    start_date = args.start_date
+    end_date = args.end_date
 
+    sensors = []
     for sensor_name, files in sensor_files.items():
-        if not all(data_type in files for data_type in ['temperature', 'humidity', 'co2']):
+        if files is not None and not all(data_type in files for data_type in ['temperature', 'humidity', 'co2']):
             print(f"Error: Missing data files for sensor {sensor_name}")
             continue
+        sensors.append((sensor_name, files))
 
-        try:
-            df = process_data(
-                os.path.join(input_folder, files['temperature']),
-                os.path.join(input_folder, files['humidity']),
-                os.path.join(input_folder, files['co2'])
-            )
-
-            print(f"Data range for {sensor_name}: {df.index.min()} to {df.index.max()}")
-
-            start_date = '2024-04-25'
-            end_date = '2024-06-09'
-            stats = analyze_data(df, start_date, end_date)
-            
-            if stats is None:
-                print(f"Error: Failed to analyze data for sensor {sensor_name}")
-                continue
-
-            all_stats[sensor_name] = stats
+    manifest_path = os.path.join(script_dir, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    sensor_inputs = {}
+    for sensor_name, files in sorted(sensor_files.items()):
+        if files is None:
+            sensor_inputs[sensor_name] = list(series_paths(store_folder, sensor_name))
+        else:
+            sensor_inputs[sensor_name] = [os.path.join(input_folder, f) for f in sorted(files.values())]
+    inputs = [f for sensor_name in sorted(sensor_inputs) for f in sensor_inputs[sensor_name]]
 
-            hourly_averages = calculate_hourly_averages(df[start_date:end_date])
-            all_hourly_averages[sensor_name] = hourly_averages
+    try:
+        windows = windows_from_args(args, start_date, end_date)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        print(f"Error reading the study windows: {str(e)}")
+        return
+    if windows:
+        thresholds = {'ppd_thresholds': args.ppd_thresholds, 'co2_thresholds': args.co2_thresholds}
+        window_comparison(sensors, inputs, input_folder, store_folder, output_folder, windows, thresholds,
+                          manifest, manifest_path, args.jobs, args.sidecar, args.force)
+        return
 
-            print(f"\nStatistics for {sensor_name}:")
-            for key, value in stats.items():
-                if isinstance(value, float):
-                    print(f"{key}: {value:.2f}")
-                else:
-                    print(f"{key}:\n{value}")
+    if args.fleet:
+        fleet_comparison(sensors, inputs, input_folder, store_folder, output_folder, start_date, end_date,
+                         manifest, manifest_path, args.force)
+        return
 
-        except Exception as e:
-            print(f"Error processing data for sensor {sensor_name}: {str(e)}")
+    # The workbook only needs rebuilding when a sensor file or a parameter changed
+    excel_file = os.path.join(output_folder, 'all_sensors_statistics.xlsx')
+    outputs = [excel_file]
+    if args.sidecar:
+        outputs += [sidecar_path(output_folder, name, args.sidecar) for name in ['overall'] + GROUPINGS + ['hourly_averages']]
+    params = {'stage': 'analysis', 'start_date': start_date, 'end_date': end_date, 'comfort': comfort_params(),
+              'ppd_thresholds': args.ppd_thresholds, 'co2_thresholds': args.co2_thresholds, 'sidecar': args.sidecar}
+    if not args.force and is_up_to_date(manifest, outputs, inputs, params):
+        print(f"Excel file is up to date: {excel_file}")
+        return
 
-    if not all_stats:
+    # The workbook is rewritten from the results of every sensor, but only sensors
+    # whose own inputs changed are analysed again
+    thresholds = {'ppd_thresholds': args.ppd_thresholds, 'co2_thresholds': args.co2_thresholds}
+    sensor_params = {'stage': 'analysis_sensor', 'start_date': start_date, 'end_date': end_date, 'comfort': comfort_params(),
+                     **thresholds}
+    analysis_args = (input_folder, store_folder, start_date, end_date, args.ppd_thresholds, args.co2_thresholds, args.pmv_diagnostics)
+    results = cached_sensor_results(sensors, sensor_inputs, sensor_params, manifest, args.jobs, args.force, *analysis_args)
+    if not write_statistics_workbook(excel_file, results, thresholds, output_folder, args.sidecar):
+        save_manifest(manifest, manifest_path)
         print("No valid data to create Excel file.")
         return
 
-    # Create Excel file
-    excel_file = os.path.join(output_folder, 'all_sensors_statistics.xlsx')
-    with pd.ExcelWriter(excel_file) as writer:
-        overall_stats = pd.DataFrame(all_stats).T
-        overall_stats.to_excel(writer, sheet_name='Overall Statistics')
-
-        # Hourly averages
-        hourly_data = pd.DataFrame()
-        for sensor, averages in all_hourly_averages.items():
-            sensor_data = pd.DataFrame({
-                f'{sensor} PPD': [f"{averages[hour]['ppd']:.2f}%" for hour in [0, 6, 12, 18]],
-                f'{sensor} Temperature': [f"{averages[hour]['temperature']:.2f}°C" for hour in [0, 6, 12, 18]]
-            }, index=['00:00', '06:00', '12:00', '18:00'])
-            hourly_data = pd.concat([hourly_data, sensor_data], axis=1)
-        
-        hourly_data.to_excel(writer, sheet_name='Hourly Averages')
+    record(manifest, outputs, inputs, params)
+    save_manifest(manifest, manifest_path)
 
     print(f"\nExcel file with statistics for all sensors has been saved: {excel_file}")
+    if args.sidecar:
+        print(f"{args.sidecar.upper()} copies of every sheet have been saved in {output_folder}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,230 @@
+import argparse
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import matplotlib
+from matplotlib.collections import PatchCollection
+from matplotlib.patches import Rectangle
+from chart_options import CHART_FORMATS, HEATMAP_MODES
+from comfort import add_diagnostics_argument, comfort_params
+from manifest import MANIFEST_FILE, is_up_to_date, load_manifest, record, save_manifest
+from run_report import measure, measured_call, run_settings, worker_result
+from series_store import list_sensors
+from study_windows import add_period_arguments
+
+CO2_THRESHOLD = 700  # ppm
+
+# Overlay pages already parsed in this process, keyed on the overlay file path
+_overlay_pages = {}
+
+def period_label(start_date, end_date):
+    # Study period in file names, for example 'Apr23_Jun09'
+    return f'{pd.Timestamp(start_date):%b%d}_{pd.Timestamp(end_date):%b%d}'
+
+def period_title(index):
+    # Study period in chart titles, taken from the hours that are drawn
+    return f'({index[0]:%B %d} TO {index[-1]:%B %d})'.upper()
+
+def heatmap_day_labels(ax, index):
+    # One tick per heatmap column, labelled with the day of the month of that column
+    days = index[::24]
+    ax.set_xticks(np.arange(0, len(days), 1))
+    ax.set_xticklabels([day.day for day in days], ha='center')
+
+def use_agg_backend():
+    # Worker processes only write files, so they never need an interactive backend
+    matplotlib.use('Agg')
+
+def render_measured(render_sensor, base_name, *args):
+    with measure('chart', base_name):
+        return render_sensor(base_name, *args)
+
+def render_all(render_sensor, base_names, *args, jobs=1):
+    # Render one chart per sensor, in worker processes when jobs > 1. A failing
+    # sensor is recorded and reported instead of stopping the batch.
+    chart_files = {}
+    failures = {}
+    if jobs <= 1:
+        for base_name in base_names:
+            try:
+                chart_files[base_name] = render_measured(render_sensor, base_name, *args)
+                print(f"Chart created for {base_name}")
+            except Exception as e:
+                failures[base_name] = str(e)
+                print(f"Error creating chart for {base_name}: {str(e)}")
+        return chart_files, failures
+
+    # The timings the workers record are passed back with their charts
+    settings = run_settings()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=use_agg_backend) as executor:
+        futures = {executor.submit(measured_call, settings, render_measured, render_sensor, base_name, *args): base_name
+                   for base_name in base_names}
+        for future in as_completed(futures):
+            base_name = futures[future]
+            try:
+                chart_files[base_name] = worker_result(future.result())
+                print(f"Chart created for {base_name}")
+            except Exception as e:
+                failures[base_name] = str(e)
+                print(f"Error creating chart for {base_name}: {str(e)}")
+    return chart_files, failures
+
+def chart_main(description, render_sensor, input_files, chart_file_path, report_file_path, params, script_dir, shared_files=()):
+    # Command line of the chart scripts. input_files(store_folder, input_folder, base_name)
+    # lists the files a sensor's chart is made from; shared_files are inputs of every
+    # chart, used when they exist. params identify the script in the manifest, and
+    # their start_date and end_date are the default study period.
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes used to render the charts')
+    parser.add_argument('--heatmap', choices=HEATMAP_MODES, default='vector', help='Draw the PPD heatmap as vector cells or as one rasterized image')
+    parser.add_argument('--format', choices=CHART_FORMATS, default='pdf', help='File format of the charts')
+    parser.add_argument('--report', action='store_true', help='Write one multi-page PDF report with every sensor instead of one file per sensor')
+    parser.add_argument('--force', action='store_true', help='Render every chart, even if its inputs have not changed')
+    add_period_arguments(parser, params['start_date'], params['end_date'])
+    add_diagnostics_argument(parser)
+    args = parser.parse_args()
+    if args.report and args.format != 'pdf':
+        parser.error('--report only supports --format pdf')
+
+    input_folder = os.path.join(script_dir, 'output_ladybug')
+    store_folder = os.path.join(script_dir, 'output_store')
+    output_folder = os.path.join(script_dir, 'charts')
+    os.makedirs(output_folder, exist_ok=True)
+
+    if not os.path.exists(input_folder) and not os.path.exists(store_folder):
+        print(f"Error: Input folder '{input_folder}' does not exist.")
+        exit(1)
+
+    base_names = set(list_sensors(store_folder, 'temperature'))
+    if os.path.exists(input_folder):
+        base_names.update(f.replace('_temperature_ladybug.txt', '') for f in os.listdir(input_folder) if f.endswith('_temperature_ladybug.txt'))
+    if not base_names:
+        print(f"Error: No temperature files found in '{input_folder}'.")
+        exit(1)
+
+    # Only render sensors whose data, overlay or parameters changed since the last run
+    manifest_path = os.path.join(script_dir, MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    params = dict(params, start_date=args.start_date, end_date=args.end_date, heatmap=args.heatmap, comfort=comfort_params())
+    period = (args.start_date, args.end_date)
+    overlay_file = os.path.join(script_dir, 'charts', 'overlay.pdf')
+    if not os.path.exists(overlay_file):
+        overlay_file = None
+    shared_inputs = [f for f in [overlay_file, *shared_files] if f and os.path.exists(f)]
+
+    if args.report:
+        # One report page per sensor, rendered in memory and written to disk once
+        base_names = sorted(base_names)
+        report_path = report_file_path(output_folder, *period)
+        inputs = [f for base_name in base_names for f in input_files(store_folder, input_folder, base_name)] + shared_inputs
+        if not args.force and is_up_to_date(manifest, report_path, inputs, params):
+            print("Report is up to date")
+            return
+        chart_pdfs, failures = render_all(render_sensor, base_names, input_folder, store_folder, None,
+                                          args.heatmap, 'pdf', overlay_file, args.pmv_diagnostics, *period, jobs=args.jobs)
+        write_report([chart_pdfs[base_name] for base_name in base_names if base_name in chart_pdfs], report_path)
+        if not failures:
+            record(manifest, report_path, inputs, params)
+            save_manifest(manifest, manifest_path)
+
+        print(f"\nReport has been saved as {report_path}.")
+        print(f"{len(chart_pdfs)} charts created, {len(failures)} failed.")
+        for base_name, error in failures.items():
+            print(f"  {base_name}: {error}")
+        return
+
+    inputs = {}
+    for base_name in sorted(base_names):
+        inputs[base_name] = input_files(store_folder, input_folder, base_name) + shared_inputs
+        if not args.force and is_up_to_date(manifest, chart_file_path(output_folder, base_name, args.format, *period),
+                                           inputs[base_name], params):
+            print(f"Chart for {base_name} is up to date")
+            del inputs[base_name]
+
+    chart_files, failures = render_all(render_sensor, list(inputs), input_folder, store_folder, output_folder,
+                                       args.heatmap, args.format, overlay_file, args.pmv_diagnostics, *period, jobs=args.jobs)
+    for base_name, chart_file in chart_files.items():
+        record(manifest, chart_file, inputs[base_name], params)
+    save_manifest(manifest, manifest_path)
+
+    print(f"\n{args.format.upper()} charts have been saved in the {output_folder} folder.")
+    print(f"{len(chart_files)} charts created, {len(failures)} failed.")
+    for base_name, error in failures.items():
+        print(f"  {base_name}: {error}")
+
+def overlay_page(overlay_file):
+    # Parse the overlay PDF once per process instead of once per chart
+    if overlay_file not in _overlay_pages:
+        import PyPDF2
+        with open(overlay_file, 'rb') as f:
+            _overlay_pages[overlay_file] = PyPDF2.PdfReader(io.BytesIO(f.read())).pages[0]
+    return _overlay_pages[overlay_file]
+
+def chart_pdf_bytes(fig, overlay_file=None):
+    # Render the figure to an in-memory PDF and merge the overlay page onto it
+    buffer = io.BytesIO()
+    with measure('savefig'):
+        fig.savefig(buffer, format='pdf', dpi=300, bbox_inches='tight')
+    if overlay_file is None:
+        return buffer.getvalue()
+    with measure('overlay_merge'):
+        import PyPDF2
+        page = PyPDF2.PdfReader(buffer).pages[0]
+        page.merge_page(overlay_page(overlay_file))
+        pdf_writer = PyPDF2.PdfWriter()
+        pdf_writer.add_page(page)
+        merged = io.BytesIO()
+        pdf_writer.write(merged)
+        return merged.getvalue()
+
+def save_chart(fig, output_file_path, file_format='pdf', overlay_file=None):
+    # Write the chart to disk in a single write; the overlay only applies to PDF output
+    if file_format != 'pdf':
+        with measure('savefig'):
+            fig.savefig(output_file_path, dpi=300, bbox_inches='tight', format=file_format)
+        return
+    with open(output_file_path, 'wb') as f:
+        f.write(chart_pdf_bytes(fig, overlay_file))
+
+def write_report(chart_pdfs, report_path):
+    # Combine single-page chart PDFs, in the given order, into one multi-page report
+    import PyPDF2
+    pdf_writer = PyPDF2.PdfWriter()
+    for pdf in chart_pdfs:
+        pdf_writer.add_page(PyPDF2.PdfReader(io.BytesIO(pdf)).pages[0])
+    with open(report_path, 'wb') as f:
+        pdf_writer.write(f)
+
+def add_co2_overlay(ax, co2_heatmap, threshold=CO2_THRESHOLD):
+    # Hatch every heatmap cell above the CO2 threshold. All cells go into a single
+    # collection, so drawing and PDF size do not grow with one artist per cell.
+    rows, cols = np.nonzero(co2_heatmap > threshold)
+    cells = [Rectangle((j, i), 1, 1) for i, j in zip(rows, cols)]
+    overlay = PatchCollection(cells, facecolor='none', edgecolor='#9a9a9a', linewidth=1.5, hatch='...', alpha=0.7)
+    ax.add_collection(overlay)
+    return overlay
+
+def add_door_markers(ax, door_heatmap):
+    # Mark every heatmap cell where the door was open with one scatter call
+    rows, cols = np.nonzero(door_heatmap)
+    return ax.scatter(cols + 0.5, rows + 0.5, marker='x', color='k', s=25, linewidths=2)
+
+def draw_ppd_heatmap(ax, ppd_heatmap, cmap, norm, bounds, mode='vector'):
+    # Draw the PPD heatmap and return its colorbar. seaborn is only imported for
+    # vector heatmaps, the raster mode does not need it.
+    if mode == 'vector':
+        with measure('ppd_heatmap', rows=ppd_heatmap.size):
+            import seaborn as sns
+            sns.heatmap(ppd_heatmap, ax=ax, cmap=cmap, norm=norm, cbar_kws={'label': 'PPD (%)', 'ticks': bounds}, linewidths=0.5, linecolor='white')
+            return ax.collections[0].colorbar
+
+    # Same cell layout as seaborn: cell (i, j) covers [j, j + 1] x [i, i + 1], row 0 at the top
+    rows, cols = ppd_heatmap.shape
+    with measure('ppd_heatmap', rows=ppd_heatmap.size):
+        mesh = ax.pcolormesh(np.arange(cols + 1), np.arange(rows + 1), ppd_heatmap, cmap=cmap, norm=norm,
+                             edgecolors='white', linewidth=0.5, rasterized=True)
+        ax.set_xlim(0, cols)
+        ax.set_ylim(rows, 0)
+        return ax.figure.colorbar(mesh, ax=ax, label='PPD (%)', ticks=bounds)
@@ -0,0 +1,7 @@
+# Choices of the chart scripts, kept apart from chart_common so scripts can offer them
+# without importing matplotlib
+
+# 'vector' draws every heatmap cell as a PDF/SVG path, 'raster' draws the heatmap
+# body as one embedded image while axes, text and overlays stay vector
+HEATMAP_MODES = ['vector', 'raster']
+CHART_FORMATS = ['pdf', 'png', 'svg']
@@ -0,0 +1,138 @@
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import time
+from run_report import PROFILE_FILE, finish_run, measure, start_run
+
+# One entry point for every stage: python cli.py <command> [options]. Each command
+# runs the main() of its script with the remaining options, and only the script of
+# the chosen command is imported, so pandas, matplotlib, seaborn, scipy and PyPDF2
+# are only loaded by the commands that use them. With --report the stages and
+# sensors the command runs are timed and written to a JSON run report.
+
+# Script and import time budget in seconds of every command
+COMMANDS = {
+    'ingest': ('process_data', 1.0, 'Create hourly series and Ladybug files from Aranet CSV exports'),
+    'door': ('doorlog', 1.0, 'Create door open files from door logger CSV files'),
+    'analyze': ('analysis', 1.0, 'Create the Excel workbook with the statistics of all sensors'),
+    'correlate': ('doorlogger_correlation', 1.2, 'Correlate door opening with PPD and CO2'),
+    'chart': ('chart_maker', 2.0, 'Create the PPD, temperature and CO2 charts; --door adds the door logger data'),
+    'run': ('pipeline', 1.0, 'Run every stage in memory, from the Aranet exports to the statistics and charts'),
+}
+DOOR_CHART_SCRIPT = 'chart_maker_door'
+
+# Run report written when --profile or --trace-memory is given without --report
+REPORT_FILE = 'run_report.json'
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def import_script(script):
+    # Import a script and return it with the seconds the import took
+    start = time.perf_counter()
+    module = importlib.import_module(script)
+    return module, time.perf_counter() - start
+
+def run_command(command, script, arguments, show_import_time=False):
+    with measure('import', script):
+        module, seconds = import_script(script)
+    budget = COMMANDS[command][1]
+    if show_import_time or seconds > budget:
+        print(f"Imported {script} in {seconds:.2f} s (budget {budget:.1f} s)")
+    # The script parses sys.argv itself, so its own options and --help work unchanged
+    sys.argv = [f'{sys.argv[0]} {command}'] + arguments
+    module.main()
+
+def measure_imports(commands):
+    # Import time of every command's script in a fresh interpreter, so modules that
+    # are already loaded do not hide their cost. Returns the number over budget.
+    over_budget = 0
+    scripts = [(command, COMMANDS[command][0]) for command in commands]
+    if 'chart' in commands:
+        scripts.append(('chart', DOOR_CHART_SCRIPT))
+    for command, script in scripts:
+        code = f"import time; start = time.perf_counter(); import {script}; print(time.perf_counter() - start)"
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=SCRIPT_DIR)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()
+            print(f"Error importing {script}: {error[-1] if error else result.returncode}")
+            over_budget += 1
+            continue
+        seconds = float(result.stdout.strip().splitlines()[-1])
+        budget = COMMANDS[command][1]
+        status = 'ok' if seconds <= budget else 'over budget'
+        if seconds > budget:
+            over_budget += 1
+        print(f"{command:10} {script:24} {seconds:6.2f} s  budget {budget:4.1f} s  {status}")
+    return over_budget
+
+def check_solvers(samples):
+    # Compare every PMV solver with calculate_pmv_scalar within its tolerance.
+    # Returns the number of solvers that failed.
+    from comfort import PMV_SOLVERS, check_solver
+    failed = 0
+    for method in PMV_SOLVERS:
+        try:
+            result = check_solver(method, samples)
+        except ValueError as e:
+            print(f"Error: {str(e)}")
+            failed += 1
+            continue
+        print(f"{method:12} max PMV error {result['pmv_error']:.2e}  max PPD error {result['ppd_error']:.2e}  ok")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a stage of the sensor data workflow.',
+                                     epilog="Run 'cli.py <command> --help' for the options of a command.")
+    parser.add_argument('--import-time', action='store_true', help="Print how long the command's imports took")
+    parser.add_argument('--report', metavar='FILE', help='Write the time, CPU time, memory and rows of every stage and sensor to a JSON run report')
+    parser.add_argument('--profile', metavar='STAGE', help='Profile every call of this stage with cProfile (implies a report)')
+    parser.add_argument('--profile-file', metavar='FILE', help=f"cProfile output file (default {PROFILE_FILE.format(stage='<STAGE>')})")
+    parser.add_argument('--trace-memory', action='store_true', help='Also record the peak Python memory of every stage with tracemalloc; slows the run down')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    for command, (script, _, description) in COMMANDS.items():
+        # The options of the command are left for its script to parse
+        subparser = subparsers.add_parser(command, help=description, add_help=False, allow_abbrev=False)
+        if command == 'chart':
+            subparser.add_argument('--door', action='store_true', help='Add the door logger data to the charts')
+    imports_parser = subparsers.add_parser('imports', help='Measure the import time of every command against its budget')
+    imports_parser.add_argument('commands', nargs='*', help=f"Commands to measure: {', '.join(COMMANDS)} (default all)")
+    solvers_parser = subparsers.add_parser('solvers', help='Check every PMV solver against the scalar reference')
+    solvers_parser.add_argument('--samples', type=int, default=2000, help='Number of random readings compared')
+    args, arguments = parser.parse_known_args()
+
+    if args.command == 'imports':
+        unknown = arguments + [command for command in args.commands if command not in COMMANDS]
+        if unknown:
+            parser.error(f"unrecognized arguments: {' '.join(unknown)}")
+        over_budget = measure_imports(args.commands or list(COMMANDS))
+        sys.exit(1 if over_budget else 0)
+    if args.command == 'solvers':
+        if arguments:
+            parser.error(f"unrecognized arguments: {' '.join(arguments)}")
+        sys.exit(check_solvers(args.samples))
+
+    script = COMMANDS[args.command][0]
+    if args.command == 'chart' and args.door:
+        script = DOOR_CHART_SCRIPT
+    report_file = args.report
+    if report_file is None and (args.profile or args.trace_memory):
+        report_file = REPORT_FILE
+    if report_file is None:
+        run_command(args.command, script, arguments, args.import_time)
+        return
+
+    start_run(args.command, args.profile, args.profile_file, args.trace_memory)
+    try:
+        run_command(args.command, script, arguments, args.import_time)
+    finally:
+        report = finish_run(report_file)
+        print(f"Run report has been saved: {report_file}")
+        if report['profile']:
+            files = report['profile']['files']
+            print(f"Profile of {report['profile']['stage']}: {', '.join(files) if files else 'the stage did not run'}")
+
+if __name__ == "__main__":
+    main()
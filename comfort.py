@@ -0,0 +1,280 @@
+import math
+import numpy as np
+
+# Define thermal comfort parameters
+AIR_SPEED = 0.1  # m/s
+CLOTHING_LEVEL = 0.6  # clo
+METABOLIC_RATE = 1.0  # met
+EXTERNAL_WORK = 0  # met
+
+# Value returned for PMV when the clothing temperature iteration does not converge
+PMV_NOT_CONVERGED = 1000
+MAX_ITERATIONS = 150
+
+# Clothing surface temperature solver used by calculate_pmv, see PMV_SOLVERS
+PMV_SOLVER = 'newton'
+
+# Print iteration counts and non-converged hours for every sensor; the scripts'
+# --pmv-diagnostics option turns it on for one run
+PMV_DIAGNOSTICS = False
+
+# Look PPD up from the precomputed grid in ppd_grid.py instead of solving PMV for every reading
+USE_PPD_GRID = False
+
+# With method='fixed_point' the array engine runs the same iteration as the scalar
+# reference, so converged values agree with calculate_pmv_scalar to within
+# PMV_TOLERANCE (floating point noise from numpy vs math) and PPD to within
+# PPD_TOLERANCE percentage points. The Newton solver stops on the same step size
+# but lands closer to the true root, so it differs from the reference by up to
+# NEWTON_PMV_TOLERANCE. check_solver tests this on random readings.
+PMV_TOLERANCE = 1e-9
+PPD_TOLERANCE = 1e-7
+NEWTON_PMV_TOLERANCE = 0.01
+
+def comfort_params():
+    # Everything that changes the PPD values, used to key caches and the manifest
+    return {
+        'air_speed': AIR_SPEED,
+        'clothing_level': CLOTHING_LEVEL,
+        'metabolic_rate': METABOLIC_RATE,
+        'external_work': EXTERNAL_WORK,
+        'solver': PMV_SOLVER,
+        'use_ppd_grid': USE_PPD_GRID,
+    }
+
+def calculate_pmv_scalar(ta, tr, vel, rh, met, clo, wme):
+    # Reference implementation for a single reading, kept to validate the array engine
+    pa = rh * 10 * math.exp(16.6536 - 4030.183 / (ta + 235))
+    icl = 0.155 * clo
+    m = met * 58.15
+    w = wme * 58.15
+    mw = m - w
+    fcl = 1.05 + 0.645 * icl
+    hcf = 12.1 * math.sqrt(vel)
+    taa = ta + 273
+    tra = tr + 273
+    tcla = taa + (35.5 - ta) / (3.5 * icl + 0.1)
+    p1 = icl * fcl
+    p2 = p1 * 3.96
+    p3 = p1 * 100
+    p4 = p1 * taa
+    p5 = 308.7 - 0.028 * mw + p2 * (tra / 100.0) ** 4
+    xn = tcla / 100
+    xf = tcla / 50
+    eps = 0.00015
+    n = 0
+    hc = hcf  # Initialize hc with hcf
+    while abs(xn - xf) > eps:
+        xf = (xf + xn) / 2
+        hcn = 2.38 * abs(100.0 * xf - taa) ** 0.25
+        if hcf > hcn:
+            hc = hcf
+        else:
+            hc = hcn
+        xn = (p5 + p4 * hc - p2 * math.pow(xf, 4)) / (100 + p3 * hc)
+        n += 1
+        if n > MAX_ITERATIONS:
+            return PMV_NOT_CONVERGED
+    tcl = 100 * xn - 273
+    hl1 = 3.05 * 0.001 * (5733 - 6.99 * mw - pa)
+    hl2 = 0.42 * (mw - 58.15)
+    hl3 = 1.7 * 0.00001 * m * (5867 - pa)
+    hl4 = 0.0014 * m * (34 - ta)
+    hl5 = 3.96 * fcl * (math.pow(xn, 4) - math.pow(tra / 100.0, 4))
+    hl6 = fcl * hc * (tcl - ta)
+    ts = 0.303 * math.exp(-0.036 * m) + 0.028
+    pmv = ts * (mw - hl1 - hl2 - hl3 - hl4 - hl5 - hl6)
+    return pmv
+
+def _solve_fixed_point(tcla, hcf, taa, tra, mw, p1, p2, p3, p4, p5, eps):
+    # Damped fixed-point iteration from the original ISO 7730 code, run on the
+    # elements that have not converged yet
+    xn = tcla / 100
+    xf = tcla / 50
+    hc = hcf.copy()
+    iterations = np.zeros(xn.shape, dtype=int)
+    active = np.flatnonzero(np.abs(xn - xf) > eps)
+    n = 0
+    while active.size and n < MAX_ITERATIONS:
+        xf_a = (xf[active] + xn[active]) / 2
+        hcn = 2.38 * np.abs(100.0 * xf_a - taa[active]) ** 0.25
+        hc_a = np.maximum(hcf[active], hcn)
+        xn_a = (p5[active] + p4[active] * hc_a - p2[active] * xf_a ** 4) / (100 + p3[active] * hc_a)
+        xf[active], hc[active], xn[active] = xf_a, hc_a, xn_a
+        iterations[active] += 1
+        active = active[np.abs(xn_a - xf_a) > eps]
+        n += 1
+    converged = np.ones(xn.shape, dtype=bool)
+    converged[active] = False
+    return xn, hc, iterations, converged
+
+def _solve_newton(tcla, hcf, taa, tra, mw, p1, p2, p3, p4, p5, eps):
+    # Safeguarded Newton iteration on the heat balance of the clothing surface,
+    #   F(x) = x * (100 + p3 * hc) - p5 - p4 * hc + p2 * x ** 4,  x = tcl / 100 (K)
+    # F is strictly increasing in x, and it is <= 0 at the lowest and >= 0 at the
+    # highest of air, radiant and skin-side temperature, so the root is always
+    # bracketed. Newton steps that leave the bracket are replaced by bisection,
+    # which guarantees convergence; in practice it takes 3-5 iterations.
+    skin = 308.7 - 0.028 * mw
+    lo = np.minimum(np.minimum(taa, tra), skin) / 100
+    hi = np.maximum(np.maximum(taa, tra), skin) / 100
+    x = np.clip(tcla / 100, lo, hi)
+    hc = hcf.copy()
+    iterations = np.zeros(x.shape, dtype=int)
+    active = np.flatnonzero(~np.isnan(x))
+    n = 0
+    while active.size and n < MAX_ITERATIONS:
+        x_a = x[active]
+        d = 100.0 * x_a - taa[active]
+        hcn = 2.38 * np.abs(d) ** 0.25
+        free = hcn > hcf[active]
+        hc_a = np.where(free, hcn, hcf[active])
+        f = x_a * (100 + p3[active] * hc_a) - p5[active] - p4[active] * hc_a + p2[active] * x_a ** 4
+        df = 100 + p3[active] * hc_a + 4 * p2[active] * x_a ** 3 + np.where(free, 59.5 * p1[active] * np.abs(d) ** 0.25, 0)
+
+        lo_a = np.where(f < 0, x_a, lo[active])
+        hi_a = np.where(f > 0, x_a, hi[active])
+        x_new = x_a - f / df
+        outside = (x_new <= lo_a) | (x_new >= hi_a)
+        x_new = np.where(outside & (f != 0), (lo_a + hi_a) / 2, x_new)
+
+        x[active], hc[active], lo[active], hi[active] = x_new, hc_a, lo_a, hi_a
+        iterations[active] += 1
+        active = active[np.abs(x_new - x_a) > eps]
+        n += 1
+    converged = np.ones(x.shape, dtype=bool)
+    converged[active] = False
+    return x, hc, iterations, converged
+
+PMV_SOLVERS = {
+    'fixed_point': _solve_fixed_point,
+    'newton': _solve_newton,
+}
+
+def calculate_pmv(ta, tr, vel, rh, met, clo, wme, method=None, return_diagnostics=False):
+    # Array version of calculate_pmv_scalar: every argument may be a scalar or an array
+    # and the result has the broadcast shape. Elements that do not converge are set
+    # to PMV_NOT_CONVERGED, matching the scalar behaviour. With return_diagnostics the
+    # per-element iteration counts and convergence flags are returned as well.
+    # method defaults to PMV_SOLVER as it is when called.
+    if method is None:
+        method = PMV_SOLVER
+    ta, tr, vel, rh, met, clo, wme = np.broadcast_arrays(
+        *(np.asarray(a, dtype=float) for a in (ta, tr, vel, rh, met, clo, wme)))
+    shape = ta.shape
+    ta, tr, vel, rh, met, clo, wme = (a.ravel() for a in (ta, tr, vel, rh, met, clo, wme))
+    pa = rh * 10 * np.exp(16.6536 - 4030.183 / (ta + 235))
+    icl = 0.155 * clo
+    m = met * 58.15
+    w = wme * 58.15
+    mw = m - w
+    fcl = 1.05 + 0.645 * icl
+    hcf = 12.1 * np.sqrt(vel)
+    taa = ta + 273
+    tra = tr + 273
+    tcla = taa + (35.5 - ta) / (3.5 * icl + 0.1)
+    p1 = icl * fcl
+    p2 = p1 * 3.96
+    p3 = p1 * 100
+    p4 = p1 * taa
+    p5 = 308.7 - 0.028 * mw + p2 * (tra / 100.0) ** 4
+    eps = 0.00015
+
+    xn, hc, iterations, converged = PMV_SOLVERS[method](tcla, hcf, taa, tra, mw, p1, p2, p3, p4, p5, eps)
+
+    tcl = 100 * xn - 273
+    hl1 = 3.05 * 0.001 * (5733 - 6.99 * mw - pa)
+    hl2 = 0.42 * (mw - 58.15)
+    hl3 = 1.7 * 0.00001 * m * (5867 - pa)
+    hl4 = 0.0014 * m * (34 - ta)
+    hl5 = 3.96 * fcl * (xn ** 4 - (tra / 100.0) ** 4)
+    hl6 = fcl * hc * (tcl - ta)
+    ts = 0.303 * np.exp(-0.036 * m) + 0.028
+    pmv = ts * (mw - hl1 - hl2 - hl3 - hl4 - hl5 - hl6)
+    pmv = np.where(converged, pmv, PMV_NOT_CONVERGED).reshape(shape)
+    if return_diagnostics:
+        return pmv, {'iterations': iterations.reshape(shape), 'converged': converged.reshape(shape)}
+    return pmv
+
+def calculate_ppd(pmv):
+    pmv = np.asarray(pmv, dtype=float)
+    return 100.0 - 95.0 * np.exp(-0.03353 * pmv ** 4.0 - 0.2179 * pmv ** 2.0)
+
+def calculate_ppd_from_temp_rh(temperature, relative_humidity, air_speed=AIR_SPEED, clothing_level=CLOTHING_LEVEL,
+                               metabolic_rate=METABOLIC_RATE, external_work=EXTERNAL_WORK, use_grid=None):
+    if use_grid is None:
+        use_grid = USE_PPD_GRID
+    if use_grid:
+        from ppd_grid import load_ppd_grid, interpolate_ppd
+        grid = load_ppd_grid(air_speed, clothing_level, metabolic_rate, external_work)
+        return interpolate_ppd(grid, temperature, relative_humidity)
+    pmv = calculate_pmv(temperature, temperature, air_speed, relative_humidity, metabolic_rate, clothing_level, external_work)
+    ppd = calculate_ppd(pmv)
+    return ppd
+
+def check_solver(method=None, samples=2000, seed=0):
+    # Compare the array engine with calculate_pmv_scalar at random readings and raise
+    # when they differ by more than the documented tolerance
+    if method is None:
+        method = PMV_SOLVER
+    rng = np.random.default_rng(seed)
+    temperature = rng.uniform(-10.0, 50.0, samples)
+    relative_humidity = rng.uniform(0.0, 100.0, samples)
+    reference = np.array([calculate_pmv_scalar(ta, ta, AIR_SPEED, rh, METABOLIC_RATE, CLOTHING_LEVEL, EXTERNAL_WORK)
+                          for ta, rh in zip(temperature, relative_humidity)])
+    pmv = calculate_pmv(temperature, temperature, AIR_SPEED, relative_humidity, METABOLIC_RATE, CLOTHING_LEVEL,
+                        EXTERNAL_WORK, method=method)
+    not_converged = reference == PMV_NOT_CONVERGED
+    if np.any(not_converged != (pmv == PMV_NOT_CONVERGED)):
+        raise ValueError(f"PMV solver {method} does not converge for the same readings as calculate_pmv_scalar")
+    pmv_error = float(np.max(np.abs(pmv - reference)[~not_converged], initial=0.0))
+    ppd_error = float(np.max(np.abs(calculate_ppd(pmv) - calculate_ppd(reference))[~not_converged], initial=0.0))
+    if method == 'fixed_point':
+        if pmv_error > PMV_TOLERANCE or ppd_error > PPD_TOLERANCE:
+            raise ValueError(f"PMV solver {method} differs from calculate_pmv_scalar by {pmv_error:.3g} PMV and "
+                             f"{ppd_error:.3g} PPD, allowed {PMV_TOLERANCE} and {PPD_TOLERANCE}")
+    elif pmv_error > NEWTON_PMV_TOLERANCE:
+        raise ValueError(f"PMV solver {method} differs from calculate_pmv_scalar by {pmv_error:.3g} PMV, "
+                         f"allowed {NEWTON_PMV_TOLERANCE}")
+    return {'method': method, 'samples': samples, 'pmv_error': pmv_error, 'ppd_error': ppd_error}
+
+def summarize_diagnostics(iterations, converged, method=None, index=None):
+    # Iteration counts and non-converged hours of a solve made with return_diagnostics
+    if method is None:
+        method = PMV_SOLVER
+    iterations = np.asarray(iterations).ravel()
+    not_converged = np.flatnonzero(~np.asarray(converged, dtype=bool).ravel())
+    return {
+        'method': method,
+        'hours': iterations.size,
+        'total_iterations': int(iterations.sum()),
+        'mean_iterations': float(iterations.mean()) if iterations.size else 0.0,
+        'max_iterations': int(iterations.max()) if iterations.size else 0,
+        'not_converged': int(not_converged.size),
+        'not_converged_hours': list(index[not_converged]) if index is not None else list(not_converged),
+    }
+
+def solver_diagnostics(temperature, relative_humidity, air_speed=AIR_SPEED, clothing_level=CLOTHING_LEVEL,
+                       metabolic_rate=METABOLIC_RATE, external_work=EXTERNAL_WORK, method=None, index=None):
+    # Solve once only for the diagnostics; scripts use the ones of their own solve
+    _, info = calculate_pmv(temperature, temperature, air_speed, relative_humidity, metabolic_rate,
+                            clothing_level, external_work, method=method, return_diagnostics=True)
+    return summarize_diagnostics(info['iterations'], info['converged'], method, index)
+
+def add_diagnostics_argument(parser):
+    parser.add_argument('--pmv-diagnostics', action='store_true', default=PMV_DIAGNOSTICS,
+                        help='Print the PMV solver iteration counts and the hours that did not converge for every sensor')
+
+def print_solver_diagnostics(sensor_name, comfort, index=None):
+    # comfort holds the 'iterations' and 'converged' arrays of the solve that produced
+    # the sensor's PMV, see comfort_cache.compute_comfort
+    if 'iterations' not in comfort:
+        print(f"PMV solver for {sensor_name}: no diagnostics, PPD was looked up from the grid")
+        return None
+    diagnostics = summarize_diagnostics(comfort['iterations'], comfort['converged'], index=index)
+    print(f"PMV solver ({diagnostics['method']}) for {sensor_name}: {diagnostics['hours']} hours, "
+          f"{diagnostics['mean_iterations']:.2f} mean / {diagnostics['max_iterations']} max iterations, "
+          f"{diagnostics['not_converged']} not converged")
+    for hour in diagnostics['not_converged_hours'][:10]:
+        print(f"  Not converged: {hour}")
+    return diagnostics
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import numpy as np
+import comfort
+from comfort import calculate_pmv, calculate_ppd, calculate_ppd_from_temp_rh, comfort_params
+from run_report import measure
+
+# On-disk cache of derived comfort series. The PPD (and PMV) of a sensor only depends
+# on its temperature and humidity values and the comfort parameters, so the first
+# script that needs them computes and stores them under a hash of both, and every
+# later script, process or run loads them instead of solving PMV again. Files that
+# have not been used for the longest time are removed once the cache grows past
+# MAX_CACHE_BYTES.
+
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'comfort')
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+# Set to False to always recompute
+USE_COMFORT_CACHE = True
+
+# Frame and store columns of the PMV solver's iteration counts and convergence flags,
+# kept next to the PPD they came with so print_solver_diagnostics never solves again
+DIAGNOSTIC_COLUMNS = {'iterations': 'pmv_iterations', 'converged': 'pmv_converged'}
+
+def series_key(temperature, humidity):
+    # Hash of the input values and everything that changes the result
+    digest = hashlib.sha256()
+    digest.update(json.dumps(comfort_params(), sort_keys=True).encode())
+    for values in (temperature, humidity):
+        values = np.ascontiguousarray(values, dtype=float)
+        digest.update(str(values.shape).encode())
+        digest.update(values.tobytes())
+    return digest.hexdigest()
+
+def compute_comfort(temperature, humidity):
+    # PPD and, when it is solved exactly, PMV with the solver's iteration counts and
+    # convergence flags for print_solver_diagnostics. With the PPD grid only PPD is known.
+    # The settings are read when called, as comfort_params() reads them for the cache key.
+    params = (comfort.AIR_SPEED, comfort.CLOTHING_LEVEL, comfort.METABOLIC_RATE, comfort.EXTERNAL_WORK)
+    if comfort.USE_PPD_GRID:
+        return {'ppd': calculate_ppd_from_temp_rh(temperature, humidity, *params, use_grid=True)}
+    air_speed, clothing_level, metabolic_rate, external_work = params
+    pmv, info = calculate_pmv(temperature, temperature, air_speed, humidity, metabolic_rate, clothing_level, external_work,
+                              return_diagnostics=True)
+    return {'pmv': pmv, 'ppd': calculate_ppd(pmv), 'iterations': info['iterations'].astype(np.int16), 'converged': info['converged']}
+
+def read_cache_file(cache_file):
+    try:
+        with np.load(cache_file) as data:
+            result = {name: data[name] for name in data.files}
+    except (OSError, ValueError, EOFError):
+        return None
+    # Mark the file as recently used for the eviction order
+    try:
+        os.utime(cache_file)
+    except OSError:
+        pass
+    return result
+
+def write_cache_file(cache_file, result):
+    # Write to a temporary file first, so a concurrent reader never sees half a file
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = f'{cache_file}.{os.getpid()}.tmp.npz'
+    np.savez(temp_file, **result)
+    os.replace(temp_file, cache_file)
+
+def evict(cache_folder=CACHE_FOLDER, max_bytes=MAX_CACHE_BYTES):
+    # Remove the least recently used files until the cache fits in max_bytes
+    entries = []
+    for name in os.listdir(cache_folder) if os.path.exists(cache_folder) else []:
+        if not name.endswith('.npz') or '.tmp' in name:
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_folder, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_folder, name))
+        except OSError:
+            pass
+        total -= size
+
+def comfort_series(temperature, humidity, cache_folder=CACHE_FOLDER, max_bytes=MAX_CACHE_BYTES, write_cache=True):
+    # PPD and PMV of a series, from the cache when they have been computed before. With
+    # write_cache False the cache is only read.
+    temperature = np.asarray(temperature, dtype=float)
+    humidity = np.asarray(humidity, dtype=float)
+    with measure('comfort', rows=len(temperature)) as timing:
+        if not USE_COMFORT_CACHE:
+            timing['cache'] = 'off'
+            return compute_comfort(temperature, humidity)
+
+        cache_file = os.path.join(cache_folder, f'{series_key(temperature, humidity)}.npz')
+        result = read_cache_file(cache_file) if os.path.exists(cache_file) else None
+        if result is not None and 'pmv' in result and 'iterations' not in result:
+            # Written before the solver diagnostics were kept
+            result = None
+        timing['cache'] = 'hit' if result is not None else 'miss'
+        if result is None:
+            result = compute_comfort(temperature, humidity)
+            if not write_cache:
+                return result
+            try:
+                write_cache_file(cache_file, result)
+                evict(cache_folder, max_bytes)
+            except OSError as e:
+                print(f"Error writing the comfort cache: {str(e)}")
+        return result
+
+def cached_ppd(temperature, humidity, write_cache=True):
+    return comfort_series(temperature, humidity, write_cache=write_cache)['ppd']
+
+def add_comfort_columns(df, comfort):
+    # PPD, and the solver diagnostics when PMV was solved, as columns of df
+    df['ppd'] = comfort['ppd']
+    for name, column in DIAGNOSTIC_COLUMNS.items():
+        if name in comfort:
+            df[column] = comfort[name]
+    return df
+
+def frame_comfort(df):
+    # The comfort results a frame's PPD came with. Frames written before the
+    # diagnostics were stored are looked up in the cache, and solved without adding
+    # an entry for what may only be a slice of a series.
+    if all(column in df for column in DIAGNOSTIC_COLUMNS.values()):
+        return {'ppd': df['ppd'].to_numpy(), 'iterations': df['pmv_iterations'].to_numpy().astype(np.int16),
+                'converged': df['pmv_converged'].to_numpy() > 0}
+    return comfort_series(df['temperature'].values, df['humidity'].values, write_cache=False)
@@ -0,0 +1,193 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import fft
+
+# Statistics of the effect of door openings on hourly sensor data. Arrays are laid
+# out with hours on the last axis, so one call covers any number of sensors and
+# variables by stacking them on the leading axes.
+
+# Lags in hours checked on both sides of a door opening
+MAX_LAG = 48
+
+# Lags with fewer overlapping hours than this get no correlation
+MIN_OVERLAP = 24
+
+def cross_sums(a, b, max_lag):
+    # sum over t of a[t] * b[t + lag] for every lag in -max_lag..max_lag, for all
+    # leading axes at once, computed as one FFT product
+    hours = a.shape[-1]
+    size = fft.next_fast_len(hours + max_lag, real=True)
+    product = np.conj(fft.rfft(a, size, axis=-1)) * fft.rfft(b, size, axis=-1)
+    sums = fft.irfft(product, size, axis=-1)
+    return np.concatenate([sums[..., size - max_lag:], sums[..., :max_lag + 1]], axis=-1)
+
+def lagged_correlation(door, values, max_lag=MAX_LAG, min_overlap=MIN_OVERLAP):
+    # Pearson correlation between door[t] and values[t + lag] for every lag; a positive
+    # lag means the values follow the door opening. NaN hours are left out of every lag
+    # separately, using the sums over the hours both series have. door and values are
+    # broadcast against each other, for example door (sensors, 1, hours) with values
+    # (sensors, variables, hours). Returns the lags and the correlations, with the
+    # lags on the last axis.
+    door, values = np.broadcast_arrays(np.asarray(door, dtype=float), np.asarray(values, dtype=float))
+    max_lag = min(max_lag, door.shape[-1] - 1)
+    door_valid = ~np.isnan(door)
+    values_valid = ~np.isnan(values)
+
+    # Centre both series first so the sums of squares do not lose precision
+    x = np.where(door_valid, door - np.nanmean(np.where(door_valid, door, np.nan), axis=-1, keepdims=True), 0)
+    y = np.where(values_valid, values - np.nanmean(np.where(values_valid, values, np.nan), axis=-1, keepdims=True), 0)
+    mx = door_valid.astype(float)
+    my = values_valid.astype(float)
+
+    # Every sum is a cross-correlation of a door term with a values term, so all six
+    # are stacked and go through the FFT together
+    left = np.stack([mx, x, mx, x * x, mx, x])
+    right = np.stack([my, my, y, my, y * y, y])
+    sums = cross_sums(left, right, max_lag)
+    n = np.round(sums[0])
+    sx, sy, sxx, syy, sxy = sums[1:]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = n * sxy - sx * sy
+        variance = (n * sxx - sx * sx) * (n * syy - sy * sy)
+        correlation = covariance / np.sqrt(np.where(variance > 0, variance, np.nan))
+    correlation = np.where(n >= min_overlap, np.clip(correlation, -1, 1), np.nan)
+    return np.arange(-max_lag, max_lag + 1), correlation
+
+def peak_lag(lags, correlation):
+    # Lag with the strongest correlation, positive or negative, and its correlation,
+    # for every profile on the leading axes. Profiles without any value give NaN.
+    has_value = ~np.all(np.isnan(correlation), axis=-1)
+    strength = np.where(np.isnan(correlation), -1, np.abs(correlation))
+    peak = np.argmax(strength, axis=-1)
+    peak_correlation = np.take_along_axis(correlation, peak[..., None], axis=-1)[..., 0]
+    return np.where(has_value, lags[peak], np.nan), np.where(has_value, peak_correlation, np.nan)
+
+# Resamples of the significance tests, the smallest circular shift of the door series
+# in hours, and the length of the bootstrap blocks in hours. Shifts and blocks keep
+# the hour-to-hour autocorrelation that an ordinary t-test ignores.
+RESAMPLES = 10000
+MIN_SHIFT = 48
+BLOCK_LENGTH = 24
+
+# Upper bound on resamples x hours held in memory at a time
+BATCH_CELLS = 4000000
+
+def open_closed_difference(door, values):
+    # Mean of values in open hours minus mean in closed hours. door (resamples, hours)
+    # holds 1 for open, 0 for closed and NaN for unknown; values (variables, hours).
+    # Returns (resamples, variables).
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0).T
+    valid = valid.T.astype(float)
+    is_open = (door == 1).astype(float)
+    is_closed = (door == 0).astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return is_open @ filled / (is_open @ valid) - is_closed @ filled / (is_closed @ valid)
+
+def batches(resamples, hours):
+    # Slices of resamples that keep every index matrix below BATCH_CELLS
+    size = max(1, BATCH_CELLS // max(hours, 1))
+    return [slice(start, min(start + size, resamples)) for start in range(0, resamples, size)]
+
+def circular_shift_test(door, values, resamples=RESAMPLES, min_shift=MIN_SHIFT, rng=None):
+    # Permutation test of the open-closed difference in which the door series is
+    # rotated against the values by a random shift. The null distribution keeps the
+    # autocorrelation of both series. Returns the observed difference and the
+    # two-sided p-value per variable.
+    rng = np.random.default_rng(rng)
+    door = np.asarray(door, dtype=float)
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    hours = door.shape[-1]
+    observed = open_closed_difference(door[None, :], values)[0]
+
+    min_shift = min(min_shift, hours // 2)
+    shifts = rng.integers(min_shift, hours - min_shift + 1, size=resamples)
+    exceed = np.zeros(values.shape[0])
+    for batch in batches(resamples, hours):
+        index = (np.arange(hours) + shifts[batch, None]) % hours
+        null = open_closed_difference(door[index], values)
+        exceed += np.sum(np.abs(null) >= np.abs(observed), axis=0)
+    p_value = np.where(np.isnan(observed), np.nan, (exceed + 1) / (resamples + 1))
+    return observed, p_value
+
+def block_bootstrap(door, values, resamples=RESAMPLES, block_length=BLOCK_LENGTH, rng=None, confidence=0.95):
+    # Moving block bootstrap of the open-closed difference: hours are resampled in
+    # blocks of consecutive hours, door and values together, so the resamples keep the
+    # autocorrelation within a block. Each resample is a row of block starts; the sums
+    # over a block come from prefix sums, so a resample costs one lookup per block
+    # instead of one per hour. Returns the standard error and the lower and upper
+    # confidence limits per variable.
+    rng = np.random.default_rng(rng)
+    door = np.asarray(door, dtype=float)
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    hours = door.shape[-1]
+    block_length = max(1, min(block_length, hours))
+    blocks = -(-hours // block_length)
+    last_length = hours - (blocks - 1) * block_length
+
+    # Per hour: values and counts in open hours, values and counts in closed hours
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0)
+    is_open = door == 1
+    is_closed = door == 0
+    parts = np.stack([filled * is_open, valid & is_open, filled * is_closed, valid & is_closed]).astype(float)
+    prefix = np.concatenate([np.zeros(parts.shape[:-1] + (1,)), np.cumsum(parts, axis=-1)], axis=-1)
+    starts = np.arange(hours - block_length + 1)
+    block_sums = prefix[..., starts + block_length] - prefix[..., starts]
+    last_sums = prefix[..., starts + last_length] - prefix[..., starts]
+
+    differences = np.empty((resamples, values.shape[0]))
+    for batch in batches(resamples, blocks * parts.shape[0] * parts.shape[1]):
+        index = rng.integers(0, len(starts), size=(batch.stop - batch.start, blocks))
+        totals = block_sums[..., index[:, :-1]].sum(axis=-1) + last_sums[..., index[:, -1]]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            differences[batch] = (totals[0] / totals[1] - totals[2] / totals[3]).T
+
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.nanpercentile(differences, [tail, 100 - tail], axis=0)
+    return np.nanstd(differences, axis=0, ddof=1), low, high
+
+def door_effect_tests(door, values, resamples=RESAMPLES, seed=None):
+    # Circular shift p-values and block bootstrap confidence limits of the open-closed
+    # difference per variable. seed may be an int or a numpy SeedSequence.
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    shift_rng, bootstrap_rng = [np.random.default_rng(s) for s in seed.spawn(2)]
+    observed, p_value = circular_shift_test(door, values, resamples, rng=shift_rng)
+    std_error, low, high = block_bootstrap(door, values, resamples, rng=bootstrap_rng)
+    return {
+        'difference': observed,
+        'shift_p_value': p_value,
+        'bootstrap_std_error': std_error,
+        'bootstrap_low': low,
+        'bootstrap_high': high,
+    }
+
+# Hours before and after each door-open hour in the event-triggered average
+EVENT_HOURS_BEFORE = 6
+EVENT_HOURS_AFTER = 12
+
+def event_windows(values, before, after):
+    # Read-only view of the hours from before to after around every hour, shape
+    # (..., hours, before + after + 1). Hours outside the series are NaN.
+    padding = [(0, 0)] * (values.ndim - 1) + [(before, after)]
+    padded = np.pad(np.asarray(values, dtype=float), padding, constant_values=np.nan)
+    return sliding_window_view(padded, before + after + 1, axis=-1)
+
+def event_average(door, values, before=EVENT_HOURS_BEFORE, after=EVENT_HOURS_AFTER, z=1.96):
+    # Average trajectory of values around every hour with door == 1, with a normal
+    # confidence band of z standard errors. Only the windows of the events are
+    # gathered from the strided view. Returns the offsets in hours and the mean,
+    # lower and upper band and number of events with data, each (..., offsets).
+    events = np.flatnonzero(np.asarray(door) == 1)
+    windows = event_windows(values, before, after)[..., events, :]
+    valid = ~np.isnan(windows)
+    count = valid.sum(axis=-2)
+    filled = np.where(valid, windows, 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=-2) / count
+        deviation = np.where(valid, windows - mean[..., None, :], 0)
+        std = np.sqrt((deviation * deviation).sum(axis=-2) / (count - 1))
+        half_width = z * std / np.sqrt(count)
+    return np.arange(-before, after + 1), mean, mean - half_width, mean + half_width, count
@@ -1,90 +1,277 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
+from manifest import MANIFEST_FILE, is_up_to_date, load_manifest, record, save_manifest
+from run_report import measure, measured_call, run_settings, worker_result
+from series_store import has_series, ladybug_year_files, read_header, series_paths, to_ladybug_year, write_series
+
+# A reading means the door is open when its motor seconds are in this range
+DOOR_OPEN_MIN_SECONDS = 0
+DOOR_OPEN_MAX_SECONDS = 10
+
+# An hour counts as door open when the door was open for more than this many minutes
+OPEN_MINUTES_THRESHOLD = 10
+
+# Column names are detected from these parts when they are not given
+DATETIME_COLUMN_HINTS = ['datetime', 'date', 'time']
+MOTORSECONDS_COLUMN_HINTS = ['motorseconds', 'motor']
+
+# Name of the JSON summary written after a batch
+SUMMARY_FILE = 'door_summary.json'
+
+# Keys of every logger entry in the summary; the ones a log did not get to are None
+SUMMARY_KEYS = ['door_file', 'sensor', 'status', 'error', 'datetime_column', 'motorseconds_column', 'readings',
+                'open_intervals', 'first_reading', 'last_reading', 'hours', 'open_hours', 'open_minutes',
+                'longest_open_hours', 'output_files', 'seconds']
+
+def summary_entry(door_file, status, **values):
+    entry = dict.fromkeys(SUMMARY_KEYS)
+    entry.update(values, door_file=door_file, status=status)
+    return entry
+
+def door_open_intervals(times, motor_seconds):
+    # A reading describes the door since the previous reading, so an open reading
+    # covers [previous time, its time). Runs of open readings are merged into one
+    # interval. times must be sorted; returns start and end arrays in datetime64[ns].
+    is_open = (motor_seconds >= DOOR_OPEN_MIN_SECONDS) & (motor_seconds <= DOOR_OPEN_MAX_SECONDS)
+    is_open[:1] = False  # The first reading has no previous reading
+    edges = np.diff(np.concatenate(([0], is_open.astype(np.int8), [0])))
+    first_open = np.flatnonzero(edges == 1)
+    last_open = np.flatnonzero(edges == -1) - 1
+    return times[first_open - 1], times[last_open]
+
+def hourly_open_minutes(starts, ends, first_time, last_time):
+    # Minutes of open intervals falling in every hour from the hour of first_time to
+    # the hour of last_time. The cumulative open time at each hour boundary is found
+    # with one searchsorted over the sorted, non-overlapping intervals, so intervals
+    # that cross an hour boundary are split between the hours they cover.
+    hours = pd.date_range(start=pd.Timestamp(first_time).floor('H'), end=pd.Timestamp(last_time).floor('H'), freq='H')
+    boundaries = np.append(hours.values, hours.values[-1] + np.timedelta64(1, 'h')).view(np.int64)
+    starts = starts.astype('datetime64[ns]').view(np.int64)
+    ends = ends.astype('datetime64[ns]').view(np.int64)
+
+    if len(starts) == 0:
+        return pd.DataFrame({'open_duration': np.zeros(len(hours))}, index=hours)
+
+    # Open time before each interval, plus the part of the interval a boundary falls in
+    lengths = ends - starts
+    open_before = np.cumsum(lengths) - lengths
+    last = np.maximum(np.searchsorted(starts, boundaries, side='right') - 1, 0)
+    covered = open_before[last] + np.clip(boundaries - starts[last], 0, lengths[last])
+
+    open_minutes = np.diff(covered) / 60e9
+    return pd.DataFrame({'open_duration': open_minutes}, index=hours)
+
+def detect_columns(door_file):
+    # Find the datetime and motorseconds columns from the header of the export
+    columns = list(pd.read_csv(door_file, skiprows=1, sep=';', nrows=0).columns)
+
+    def find(hints):
+        for hint in hints:
+            for column in columns:
+                if hint in column.lower().replace(' ', '').replace('_', ''):
+                    return column
+        return None
+
+    datetime_column = find(DATETIME_COLUMN_HINTS)
+    motorseconds_column = find(MOTORSECONDS_COLUMN_HINTS)
+    if datetime_column is None or motorseconds_column is None:
+        raise ValueError(f"Could not detect the datetime and motorseconds columns in {columns}")
+    return datetime_column, motorseconds_column
+
+def output_files(door_file, output_folder, store_folder):
+    # A log named '<sensor>_door_logger.csv' is stored as '<sensor>_door_logger' and
+    # written as '<sensor>_door_logger.txt', the names the correlation and door chart
+    # scripts look up for that sensor. The text output is split into one Ladybug file
+    # per year once the stored series shows which years it covers.
+    door_name = os.path.splitext(os.path.basename(door_file))[0]
+    output_file = os.path.join(output_folder, f'{door_name}.txt')
+    text_files = [output_file]
+    if has_series(store_folder, door_name):
+        header = read_header(store_folder, door_name)
+        hours = pd.date_range(start=header['start'], periods=header['hours'], freq='H')
+        text_files = list(ladybug_year_files(output_file, hours).values())
+    return door_name, output_file, text_files + list(series_paths(store_folder, door_name))
+
+def read_door_hours(door_file, datetime_column, motorseconds_column):
+    # Minutes the door was open in every hour the log covers, and whether that is more
+    # than OPEN_MINUTES_THRESHOLD. Returns the hourly frame, the number of readings
+    # and the number of open intervals.
 
-def create_door_open_file(door_file, output_file, datetime_column, motorseconds_column):
     # Read the CSV file, skipping the first row (title) and using semicolon as separator
-    door_data = pd.read_csv(door_file, skiprows=1, sep=';')
+    door_data = pd.read_csv(door_file, skiprows=1, sep=';', usecols=[datetime_column, motorseconds_column])
     
     # Parse the datetime column
     door_data[datetime_column] = pd.to_datetime(door_data[datetime_column])
     
     # Convert motorseconds to numeric, replacing any non-numeric values with NaN
     door_data[motorseconds_column] = pd.to_numeric(door_data[motorseconds_column], errors='coerce')
+    door_data = door_data.dropna(subset=[datetime_column]).sort_values(datetime_column, kind='stable')
     
-    # Set the datetime as index
-    door_data.set_index(datetime_column, inplace=True)
-    
-    # Define a function to determine if the door is open
-    def is_door_open(motor_seconds):
-        return 0 <= motor_seconds <= 10
-    
-    # Add a column indicating whether the door is open
-    door_data['door_open'] = door_data[motorseconds_column].apply(is_door_open)
-    
-    # Calculate the time difference between consecutive readings
-    door_data['time_diff'] = door_data.index.to_series().diff().dt.total_seconds() / 60
-    
-    # Calculate the open duration for each reading
-    door_data['open_duration'] = door_data['door_open'] * door_data['time_diff']
-    
-    # Resample the data to hourly intervals and sum the open duration
-    door_hourly = door_data.resample('H').agg({
-        'open_duration': 'sum'
-    })
+    # Turn the readings into open intervals and split them at the hour boundaries
+    times = door_data[datetime_column].to_numpy(dtype='datetime64[ns]')
+    starts, ends = door_open_intervals(times, door_data[motorseconds_column].to_numpy(dtype=float))
+    door_hourly = hourly_open_minutes(starts, ends, times[0], times[-1])
     
     # Create a new column indicating if the door was open for more than 10 minutes in that hour
-    door_hourly['open_more_than_10min'] = (door_hourly['open_duration'] > 10).astype(int)
-    
-    # Print some diagnostic information
-    print(f"\nTotal hours with door open > 10 minutes: {door_hourly['open_more_than_10min'].sum()}")
-    print("\nTop 5 hours with longest door open time:")
-    print(door_hourly.sort_values('open_duration', ascending=False).head())
-    
-    # Create a full year of data (non-leap year)
-    start_date = door_hourly.index.min().replace(month=1, day=1, hour=0)
-    full_year = pd.date_range(start=start_date, freq='H', periods=8760)  # Force 8760 hours
-    
-    # Reindex to fill the entire year
-    door_hourly_full = door_hourly.reindex(full_year).fillna(0)
-
-    # Print values for specific hours
-    specific_hours = [
-        '2024-04-23 20:00:00',
-        '2024-04-24 13:00:00',
-        '2024-04-24 19:00:00',
-        '2024-05-14 06:00:00',
-        '2024-05-25 20:00:00',
-        '2024-05-24 06:00:00'
-    ]
-
-    print("\nValues for specific hours:")
-    for hour in specific_hours:
-        if pd.to_datetime(hour) in door_hourly_full.index:
-            open_duration = door_hourly_full.loc[hour, 'open_duration']
-            is_open_more_than_10min = door_hourly_full.loc[hour, 'open_more_than_10min']
-            print(f"{hour}: Open duration = {open_duration:.2f} minutes, Open > 10 min = {is_open_more_than_10min}")
+    door_hourly['open_more_than_10min'] = (door_hourly['open_duration'] > OPEN_MINUTES_THRESHOLD).astype(int)
+    return door_hourly, len(door_data), len(starts)
+
+def door_series_frame(door_hourly):
+    # The hourly door frame as stored; door = 1 when open more than 10 minutes
+    return door_hourly[['open_more_than_10min', 'open_duration']].rename(
+        columns={'open_more_than_10min': 'door', 'open_duration': 'door_minutes'})
+
+def write_door_text_files(door_hourly, output_file):
+    # Write the open hours as one Ladybug text file per year the log covers
+    year_files = ladybug_year_files(output_file, door_hourly.index)
+    for year, year_file in year_files.items():
+        with open(year_file, 'w') as f:
+            for value in to_ladybug_year(door_hourly['open_more_than_10min'], year).astype(int):
+                f.write(f"{value}\n")
+    return year_files
+
+def read_door_text_file(file_path):
+    # Door open text file as written by write_door_text_files: 1 for hours the door was
+    # open more than OPEN_MINUTES_THRESHOLD minutes, 0 otherwise
+    with open(file_path, 'r') as f:
+        return np.array([float(line) > 0 for line in f if line.strip()], dtype=int)
+
+def create_door_open_file(door_file, output_file, datetime_column, motorseconds_column, store_folder=None):
+    door_hourly, readings, open_intervals = read_door_hours(door_file, datetime_column, motorseconds_column)
+    year_files = write_door_text_files(door_hourly, output_file)
+
+    # Store the measured hours with their timestamps
+    if store_folder is None:
+        store_folder = os.path.join(os.getcwd(), 'output_store')
+    door_name = os.path.splitext(os.path.basename(door_file))[0]
+    write_series(store_folder, door_name, door_series_frame(door_hourly))
+
+    top_hours = door_hourly['open_duration'].nlargest(5)
+    return {
+        'readings': readings,
+        'open_intervals': open_intervals,
+        'first_reading': str(door_hourly.index.min()),
+        'last_reading': str(door_hourly.index.max()),
+        'hours': len(door_hourly),
+        'open_hours': int(door_hourly['open_more_than_10min'].sum()),
+        'open_minutes': float(door_hourly['open_duration'].sum()),
+        'longest_open_hours': {str(hour): round(float(minutes), 2) for hour, minutes in top_hours.items()},
+        'output_files': list(year_files.values()),
+    }
+
+def process_door_log(door_file, output_folder, store_folder, datetime_column=None, motorseconds_column=None):
+    # Process one door log and return its summary entry
+    started = time.perf_counter()
+    if datetime_column is None or motorseconds_column is None:
+        detected = detect_columns(door_file)
+        datetime_column = datetime_column or detected[0]
+        motorseconds_column = motorseconds_column or detected[1]
+    door_name, output_file = output_files(door_file, output_folder, store_folder)[:2]
+    summary = summary_entry(door_file, 'created', sensor=door_name, datetime_column=datetime_column,
+                            motorseconds_column=motorseconds_column)
+    with measure('door', door_name) as timing:
+        summary.update(create_door_open_file(door_file, output_file, datetime_column, motorseconds_column, store_folder))
+        timing['rows'] = summary['readings']
+    summary['seconds'] = round(time.perf_counter() - started, 3)
+    return summary
+
+def door_params(datetime_column=None, motorseconds_column=None):
+    # Settings the outputs of a door log depend on, in the manifest
+    return {'stage': 'doorlog', 'datetime_column': datetime_column, 'motorseconds_column': motorseconds_column,
+            'open_seconds': [DOOR_OPEN_MIN_SECONDS, DOOR_OPEN_MAX_SECONDS], 'open_minutes': OPEN_MINUTES_THRESHOLD}
+
+def find_door_logs(paths):
+    # Expand directories into the CSV files they contain
+    door_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            door_files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.csv'))
         else:
-            print(f"{hour}: No data available")
-    
-    # Write the results to a text file
-    with open(output_file, 'w') as f:
-        for value in door_hourly_full['open_more_than_10min']:
-            f.write(f"{value}\n")
+            door_files.append(path)
+    return door_files
+
+def process_door_logs(door_files, output_folder, store_folder, datetime_column=None, motorseconds_column=None,
+                      jobs=1, force=False, manifest_path=None):
+    # Process many door logs, in worker processes when jobs > 1, skipping logs whose
+    # outputs are up to date. A failing log is recorded in the summary instead of
+    # stopping the batch.
+    started = time.perf_counter()
+    os.makedirs(output_folder, exist_ok=True)
+    if manifest_path is None:
+        manifest_path = os.path.join(os.getcwd(), MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    params = door_params(datetime_column, motorseconds_column)
+
+    results = {}
+    pending = []
+    for door_file in door_files:
+        door_name, _, outputs = output_files(door_file, output_folder, store_folder)
+        if not force and is_up_to_date(manifest, outputs, [door_file], params):
+            results[door_file] = summary_entry(door_file, 'up to date', sensor=door_name)
+        else:
+            pending.append(door_file)
+
+    def finish(door_file, run):
+        try:
+            results[door_file] = run()
+            record(manifest, output_files(door_file, output_folder, store_folder)[2], [door_file], params)
+        except Exception as e:
+            results[door_file] = summary_entry(door_file, 'failed', error=str(e))
+        print(f"{door_file}: {results[door_file]['status']}")
+
+    args = (output_folder, store_folder, datetime_column, motorseconds_column)
+    if jobs <= 1:
+        for door_file in pending:
+            finish(door_file, lambda: process_door_log(door_file, *args))
+    else:
+        settings = run_settings()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(measured_call, settings, process_door_log, door_file, *args): door_file for door_file in pending}
+            for future in as_completed(futures):
+                finish(futures[future], lambda: worker_result(future.result()))
+    save_manifest(manifest, manifest_path)
+
+    loggers = [results[door_file] for door_file in door_files]
+    return {
+        'loggers': loggers,
+        'created': sum(r['status'] == 'created' for r in loggers),
+        'up_to_date': sum(r['status'] == 'up to date' for r in loggers),
+        'failed': sum(r['status'] == 'failed' for r in loggers),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
 
-    print(f"\nDoor open data has been saved to '{output_file}'")
-    print(f"Total lines in output file: {len(door_hourly_full)}")
+def main():
+    parser = argparse.ArgumentParser(description='Create hourly door open files from door logger CSV exports.')
+    parser.add_argument('paths', nargs='*', default=['door_logger.csv'], help='Door logger CSV files or folders of them')
+    parser.add_argument('--datetime-column', help='Name of the datetime column (detected when not given)')
+    parser.add_argument('--motorseconds-column', help='Name of the motorseconds column (detected when not given)')
+    parser.add_argument('--output-folder', default=os.path.join(os.getcwd(), 'output_ladybug'),
+                        help='Folder for the door open text files, next to the Ladybug files of the sensors')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--summary', default=SUMMARY_FILE, help='Path of the JSON summary')
+    parser.add_argument('--force', action='store_true', help='Process every log, even if it has not changed')
+    args = parser.parse_args()
 
-# Example usage
-door_file = 'door_logger.csv'  # Update this to the actual path of your CSV file
-output_file = 'door_open_data.txt'
+    door_files = find_door_logs(args.paths)
+    if not door_files:
+        print(f"Error: No door logger files found in {args.paths}")
+        exit(1)
 
-# First, let's print the column names
-temp_data = pd.read_csv(door_file, skiprows=1, sep=';')
-print("Column names in the CSV file:")
-for i, column in enumerate(temp_data.columns):
-    print(f"{i}: {column}")
+    store_folder = os.path.join(os.getcwd(), 'output_store')
+    summary = process_door_logs(door_files, args.output_folder, store_folder, args.datetime_column,
+                                args.motorseconds_column, jobs=args.jobs, force=args.force)
+    with open(args.summary, 'w') as f:
+        json.dump(summary, f, indent=2)
 
-# Now, ask the user to specify which columns to use
-datetime_column = input("Enter the name of the datetime column: ")
-motorseconds_column = input("Enter the name of the motorseconds column: ")
+    print(f"{summary['created']} door logs processed, {summary['up_to_date']} up to date, {summary['failed']} failed "
+          f"in {summary['seconds']:.1f} s. Summary saved to '{args.summary}'")
+    if summary['failed']:
+        exit(1)
 
-create_door_open_file(door_file, output_file, datetime_column, motorseconds_column)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
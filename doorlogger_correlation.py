@@ -1,89 +1,44 @@
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import math
-from scipy import stats
-
-# Define thermal comfort parameters
-AIR_SPEED = 0.1  # m/s
-CLOTHING_LEVEL = 0.6  # clo
-METABOLIC_RATE = 1.0  # met
-EXTERNAL_WORK = 0  # met
-
-def calculate_pmv(ta, tr, vel, rh, met, clo, wme):
-    pa = rh * 10 * math.exp(16.6536 - 4030.183 / (ta + 235))
-    icl = 0.155 * clo
-    m = met * 58.15
-    w = wme * 58.15
-    mw = m - w
-    fcl = 1.05 + 0.645 * icl
-    hcf = 12.1 * math.sqrt(vel)
-    taa = ta + 273
-    tra = tr + 273
-    tcla = taa + (35.5 - ta) / (3.5 * icl + 0.1)
-    p1 = icl * fcl
-    p2 = p1 * 3.96
-    p3 = p1 * 100
-    p4 = p1 * taa
-    p5 = 308.7 - 0.028 * mw + p2 * (tra / 100.0) ** 4
-    xn = tcla / 100
-    xf = tcla / 50
-    eps = 0.00015
-    n = 0
-    hc = hcf  # Initialize hc with hcf
-    while abs(xn - xf) > eps:
-        xf = (xf + xn) / 2
-        hcn = 2.38 * abs(100.0 * xf - taa) ** 0.25
-        if hcf > hcn:
-            hc = hcf
-        else:
-            hc = hcn
-        xn = (p5 + p4 * hc - p2 * math.pow(xf, 4)) / (100 + p3 * hc)
-        n += 1
-        if n > 150:
-            return 1000
-    tcl = 100 * xn - 273
-    hl1 = 3.05 * 0.001 * (5733 - 6.99 * mw - pa)
-    hl2 = 0.42 * (mw - 58.15)
-    hl3 = 1.7 * 0.00001 * m * (5867 - pa)
-    hl4 = 0.0014 * m * (34 - ta)
-    hl5 = 3.96 * fcl * (math.pow(xn, 4) - math.pow(tra / 100.0, 4))
-    hl6 = fcl * hc * (tcl - ta)
-    ts = 0.303 * math.exp(-0.036 * m) + 0.028
-    pmv = ts * (mw - hl1 - hl2 - hl3 - hl4 - hl5 - hl6)
-    return pmv
-
-def calculate_ppd(pmv):
-    return 100.0 - 95.0 * math.exp(-0.03353 * pow(pmv, 4.0) - 0.2179 * pow(pmv, 2.0))
-
-def calculate_ppd_from_temp_rh(temperature, relative_humidity, air_speed, clothing_level, metabolic_rate, external_work):
-    pmv = calculate_pmv(temperature, temperature, air_speed, relative_humidity, metabolic_rate, clothing_level, external_work)
-    ppd = calculate_ppd(pmv)
-    return ppd
+from comfort import add_diagnostics_argument, print_solver_diagnostics
+from comfort_cache import add_comfort_columns, comfort_series, frame_comfort
+from door_effects import EVENT_HOURS_AFTER, EVENT_HOURS_BEFORE, MAX_LAG, RESAMPLES, door_effect_tests, event_average, lagged_correlation, peak_lag
+from doorlog import read_door_text_file
+from run_report import measure
+from series_store import has_series, list_sensors, load_series, read_ladybug_file
+from study_windows import add_period_arguments, add_window_arguments, door_window_table, windows_from_args
+
+# Default study period, see --start-date and --end-date
+START_DATE = '2024-04-23'
+END_DATE = '2024-06-09'
+
+# Variables whose lagged correlation with door opening is computed
+LAG_VARIABLES = ['co2', 'ppd']
+
+# Variables averaged around door-open hours
+EVENT_VARIABLES = ['co2', 'temperature', 'ppd']
 
 def load_data(file_path):
     return pd.read_csv(file_path, header=None, names=['value'])
 
 def load_door_logger_data(file_path):
-    with open(file_path, 'r') as f:
-        door_data = [1 - (float(line.strip()) > 0) for line in f]  # Invert values: 0 becomes 1 (open), any positive value becomes 0 (closed)
-    return door_data
+    # 1 for open hours, the same as the door logger series in the store
+    return read_door_text_file(file_path)
 
 def process_data(temp_file, humidity_file, co2_file, door_file=None):
-    temp_data = pd.read_csv(temp_file, header=None, names=['temperature'])
-    humidity_data = pd.read_csv(humidity_file, header=None, names=['humidity'])
-    co2_data = pd.read_csv(co2_file, header=None, names=['co2'])
-
-    date_range = pd.date_range(start='2024-01-01', periods=8760, freq='H')
+    # The door text file has a value for every hour of the year, and hours outside
+    # the log are written as 0, so on this path they count as closed. Use
+    # add_store_door when the log is in the store.
     df = pd.DataFrame({
-        'temperature': temp_data['temperature'].values,
-        'humidity': humidity_data['humidity'].values,
-        'co2': co2_data['co2'].values
-    }, index=date_range)
+        'temperature': read_ladybug_file(temp_file),
+        'humidity': read_ladybug_file(humidity_file),
+        'co2': read_ladybug_file(co2_file)
+    })
 
-    df['ppd'] = df.apply(lambda row: calculate_ppd_from_temp_rh(
-        row['temperature'], row['humidity'], AIR_SPEED, CLOTHING_LEVEL, METABOLIC_RATE, EXTERNAL_WORK
-    ), axis=1)
+    add_comfort_columns(df, comfort_series(df['temperature'].values, df['humidity'].values))
 
     if door_file:
         door_data = load_door_logger_data(door_file)
@@ -91,6 +46,21 @@ def process_data(temp_file, humidity_file, co2_file, door_file=None):
 
     return df
 
+def add_store_door(df, store_folder, sensor_name):
+    # Door loggers are stored as '<sensor>_door_logger' with door = 1 for open hours.
+    # Hours the log does not cover stay NaN, so they count as neither open nor closed.
+    door_name = f'{sensor_name}_door_logger'
+    if has_series(store_folder, door_name):
+        door = load_series(store_folder, door_name, columns=['door'])['door']
+        df['door_open'] = door.reindex(df.index).astype(float)
+    return df
+
+def load_store_data(store_folder, sensor_name):
+    df = load_series(store_folder, sensor_name)
+    if 'ppd' not in df:
+        add_comfort_columns(df, comfort_series(df['temperature'].values, df['humidity'].values))
+    return add_store_door(df, store_folder, sensor_name)
+
 def analyze_correlations(df, door_data):
     df = df.copy()  
     df['door_open'] = door_data
@@ -105,58 +75,159 @@ def analyze_correlations(df, door_data):
     co2_door_open = df[df['door_open'] == 1]['co2'].mean()
     co2_door_closed = df[df['door_open'] == 0]['co2'].mean()
     
-    # Perform t-tests
-    ppd_ttest = stats.ttest_ind(df[df['door_open'] == 1]['ppd'], df[df['door_open'] == 0]['ppd'])
-    co2_ttest = stats.ttest_ind(df[df['door_open'] == 1]['co2'], df[df['door_open'] == 0]['co2'])
-    
     return {
         'corr_ppd_door': corr_ppd_door,
         'corr_co2_door': corr_co2_door,
         'ppd_door_open': ppd_door_open,
         'ppd_door_closed': ppd_door_closed,
         'co2_door_open': co2_door_open,
-        'co2_door_closed': co2_door_closed,
-        'ppd_ttest': ppd_ttest,
-        'co2_ttest': co2_ttest
+        'co2_door_closed': co2_door_closed
     }
 
+def lag_profiles(door_series, max_lag=MAX_LAG):
+    # Lagged correlation of every sensor and variable with door opening in one call.
+    # door_series maps each sensor to its door and variable values over the same hours.
+    sensors = list(door_series)
+    door = np.stack([door_series[s]['door_open'].to_numpy(dtype=float) for s in sensors])
+    values = np.stack([door_series[s][LAG_VARIABLES].to_numpy(dtype=float).T for s in sensors])
+    lags, correlation = lagged_correlation(door[:, None, :], values, max_lag)
+    peak_lags, peak_correlations = peak_lag(lags, correlation)
+
+    profiles = pd.DataFrame(
+        correlation.reshape(-1, len(lags)).T, index=pd.Index(lags, name='lag_hours'),
+        columns=pd.MultiIndex.from_product([sensors, LAG_VARIABLES], names=['sensor', 'variable'])
+    )
+    peaks = pd.DataFrame({
+        'peak_lag_hours': peak_lags.ravel(),
+        'peak_correlation': peak_correlations.ravel(),
+    }, index=profiles.columns)
+    return profiles, peaks
+
+def significance_tests(door_series, resamples=RESAMPLES, seed=None, jobs=1):
+    # Circular shift and block bootstrap tests of the open-closed difference for every
+    # sensor. Every sensor gets its own random stream spawned from seed, so the results
+    # do not depend on the number of worker processes.
+    sensors = list(door_series)
+    seeds = np.random.SeedSequence(seed).spawn(len(sensors))
+    doors = [door_series[s]['door_open'].to_numpy(dtype=float) for s in sensors]
+    values = [door_series[s][LAG_VARIABLES].to_numpy(dtype=float).T for s in sensors]
+    if jobs <= 1:
+        results = list(map(door_effect_tests, doors, values, [resamples] * len(sensors), seeds))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(door_effect_tests, doors, values, [resamples] * len(sensors), seeds))
+
+    rows = {}
+    for sensor_name, result in zip(sensors, results):
+        for i, variable in enumerate(LAG_VARIABLES):
+            rows[(sensor_name, variable)] = {key: value[i] for key, value in result.items()}
+    return pd.DataFrame.from_dict(rows, orient='index').rename_axis(['sensor', 'variable'])
+
+def event_study(door_series, before=EVENT_HOURS_BEFORE, after=EVENT_HOURS_AFTER):
+    # Average trajectory of every event variable around the door-open hours of each
+    # sensor, one row per sensor, variable and hour offset
+    tables = []
+    for sensor_name, series in door_series.items():
+        offsets, mean, low, high, count = event_average(
+            series['door_open'].to_numpy(dtype=float), series[EVENT_VARIABLES].to_numpy(dtype=float).T, before, after)
+        index = pd.MultiIndex.from_product([[sensor_name], EVENT_VARIABLES, offsets], names=['sensor', 'variable', 'offset_hours'])
+        tables.append(pd.DataFrame({
+            'mean': mean.ravel(),
+            'low': low.ravel(),
+            'high': high.ravel(),
+            'events': count.ravel(),
+        }, index=index))
+    return pd.concat(tables)
+
 def main():
+    parser = argparse.ArgumentParser(description='Correlate door opening with PPD and CO2 for every sensor.')
+    parser.add_argument('--max-lag', type=int, default=MAX_LAG, help='Largest lag in hours, before and after the door opening')
+    parser.add_argument('--resamples', type=int, default=RESAMPLES, help='Number of resamples of the significance tests')
+    parser.add_argument('--seed', type=int, help='Seed of the significance tests, for repeatable p-values')
+    parser.add_argument('--event-before', type=int, default=EVENT_HOURS_BEFORE, help='Hours before each door-open hour in the event average')
+    parser.add_argument('--event-after', type=int, default=EVENT_HOURS_AFTER, help='Hours after each door-open hour in the event average')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes used for the significance tests')
+    add_diagnostics_argument(parser)
+    add_period_arguments(parser, START_DATE, END_DATE)
+    add_window_arguments(parser)
+    args = parser.parse_args()
+
     script_dir = os.path.dirname(os.path.abspath(__file__))
     input_folder = os.path.join(script_dir, 'analysis_data')
-    
-    if not os.path.exists(input_folder):
+    store_folder = os.path.join(script_dir, 'output_store')
+    output_folder = os.path.join(script_dir, 'output')
+
+    store_sensors = list_sensors(store_folder, 'temperature')
+    if not os.path.exists(input_folder) and not store_sensors:
         print(f"Error: Input folder '{input_folder}' does not exist.")
         return
 
-    sensor_files = {}
-    for file in os.listdir(input_folder):
+    sensor_files = {sensor_name: None for sensor_name in store_sensors}
+    for file in os.listdir(input_folder) if os.path.exists(input_folder) else []:
         if file.endswith('_ladybug.txt'):
             parts = file.split('_')
             sensor_name = '_'.join(parts[:-3])  # Group by everything before the date
             data_type = parts[-2]  # co2, humidity, or temperature
             
+            if sensor_name in store_sensors:
+                continue
             if sensor_name not in sensor_files:
                 sensor_files[sensor_name] = {}
             
             sensor_files[sensor_name][data_type] = file
 
+    start_date = args.start_date
+    end_date = args.end_date
+    hours = pd.date_range(start=start_date, end=pd.Timestamp(end_date) + pd.Timedelta(hours=23), freq='H')
+    door_series = {}
+
+    # With study windows, every sensor is loaded once and only the open-closed
+    # comparison of each window is computed
+    try:
+        windows = windows_from_args(args, start_date, end_date)
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        print(f"Error reading the study windows: {str(e)}")
+        return
+    window_tables = []
+
     for sensor_name, files in sensor_files.items():
-        if not all(data_type in files for data_type in ['temperature', 'humidity', 'co2']):
-            print(f"Error: Missing data files for sensor {sensor_name}")
+        if files is None:
+            with measure('load', sensor_name) as timing:
+                df = load_store_data(store_folder, sensor_name)
+                timing['rows'] = len(df)
+        else:
+            if not all(data_type in files for data_type in ['temperature', 'humidity', 'co2']):
+                print(f"Error: Missing data files for sensor {sensor_name}")
+                continue
+
+            door_file = os.path.join(input_folder, f'{sensor_name}_door_logger.txt')
+
+            with measure('load', sensor_name) as timing:
+                df = process_data(
+                    os.path.join(input_folder, files['temperature']),
+                    os.path.join(input_folder, files['humidity']),
+                    os.path.join(input_folder, files['co2']),
+                    door_file if os.path.exists(door_file) else None
+                )
+                # The stored door log knows which hours it covers, the text file does not
+                df = add_store_door(df, store_folder, sensor_name)
+                timing['rows'] = len(df)
+        if args.pmv_diagnostics:
+            print_solver_diagnostics(sensor_name, frame_comfort(df), df.index)
+
+        if windows:
+            if 'door_open' in df.columns:
+                table = door_window_table(df, windows, LAG_VARIABLES)
+                table.insert(0, 'sensor', sensor_name)
+                window_tables.append(table)
+            else:
+                print(f"Warning: No door logger data available for {sensor_name}")
             continue
 
-        door_file = os.path.join(input_folder, f'{sensor_name}_door_logger.txt')
-        
-        df = process_data(
-            os.path.join(input_folder, files['temperature']),
-            os.path.join(input_folder, files['humidity']),
-            os.path.join(input_folder, files['co2']),
-            door_file if os.path.exists(door_file) else None
-        )
-
-        start_date = '2024-04-23'
-        end_date = '2024-06-09'
         df_filtered = df[start_date:end_date]
+        if df_filtered.empty:
+            print(f"Warning: No data for {sensor_name} between {start_date} and {end_date}")
+            continue
 
         if 'door_open' in df_filtered.columns:
             door_data_filtered = df_filtered['door_open'].values
@@ -169,10 +240,56 @@ def main():
             print(f"Average PPD when door is closed: {correlations['ppd_door_closed']:.2f}%")
             print(f"Average CO2 when door is open: {correlations['co2_door_open']:.2f} ppm")
             print(f"Average CO2 when door is closed: {correlations['co2_door_closed']:.2f} ppm")
-            print(f"PPD t-test p-value: {correlations['ppd_ttest'].pvalue:.4f}")
-            print(f"CO2 t-test p-value: {correlations['co2_ttest'].pvalue:.4f}")
+
+            # Aligned on the same hours for every sensor, for the lagged correlation
+            columns = ['door_open'] + list(dict.fromkeys(LAG_VARIABLES + EVENT_VARIABLES))
+            door_series[sensor_name] = df_filtered[columns].reindex(hours)
         else:
             print(f"Warning: No door logger data available for {sensor_name}")
 
+    if windows:
+        if not window_tables:
+            return
+        os.makedirs(output_folder, exist_ok=True)
+        windows_file = os.path.join(output_folder, 'door_window_effects.csv')
+        pd.concat(window_tables).to_csv(windows_file, index=False)
+        print(f"Door effects in {len(windows)} study windows have been saved: {windows_file}")
+        return
+
+    if not door_series:
+        return
+
+    # Door effects show up with a delay, so correlate across a range of lags
+    with measure('lag_profiles', rows=len(door_series) * len(hours)):
+        profiles, peaks = lag_profiles(door_series, args.max_lag)
+    print(f"\nStrongest correlation with door opening within {args.max_lag} hours (positive lag: after opening):")
+    for (sensor_name, variable), peak in peaks.iterrows():
+        print(f"{sensor_name} {variable}: {peak['peak_correlation']:.4f} at {peak['peak_lag_hours']:+.0f} h")
+
+    # Hourly data is strongly autocorrelated, so the p-values come from circular shifts
+    # of the door series and the confidence limits from a block bootstrap
+    with measure('significance_tests', rows=len(door_series) * len(hours)):
+        tests = significance_tests(door_series, args.resamples, args.seed, args.jobs)
+    print(f"\nDifference between open and closed hours ({args.resamples} resamples):")
+    for (sensor_name, variable), test in tests.iterrows():
+        print(f"{sensor_name} {variable}: {test['difference']:+.2f} "
+              f"(95% CI {test['bootstrap_low']:+.2f} to {test['bootstrap_high']:+.2f}), p = {test['shift_p_value']:.4f}")
+
+    # Average trajectory from before to after the door-open hours
+    with measure('event_study', rows=len(door_series) * len(hours)):
+        events = event_study(door_series, args.event_before, args.event_after)
+    print(f"\nChange from {args.event_before} h before to {args.event_after} h after a door-open hour:")
+    for (sensor_name, variable), trajectory in events.groupby(level=['sensor', 'variable'], sort=False):
+        mean = trajectory['mean'].to_numpy()
+        print(f"{sensor_name} {variable}: {mean[-1] - mean[0]:+.2f} ({int(trajectory['events'].max())} events)")
+
+    os.makedirs(output_folder, exist_ok=True)
+    tests.to_csv(os.path.join(output_folder, 'door_effect_tests.csv'))
+    events.to_csv(os.path.join(output_folder, 'door_event_average.csv'))
+    profiles_file = os.path.join(output_folder, 'door_lagged_correlation.csv')
+    profiles.to_csv(profiles_file)
+    peaks.to_csv(os.path.join(output_folder, 'door_lagged_correlation_peaks.csv'))
+    print(f"Lagged correlation profiles have been saved: {profiles_file}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+# Values of the gap mask returned by fill_same_hour
+MEASURED = 0
+FILLED = 1
+MISSING = 2
+
+# Fill a missing hour from the same hour of a day at most this many days away
+MAX_FILL_DAYS = 7
+
+def fill_same_hour(df, max_days=MAX_FILL_DAYS):
+    # Fill every missing hour from the nearest day that has a value at the same hour
+    # of day, looking up to max_days back or forward (the previous day wins a tie).
+    # df needs an hourly index without gaps. Returns the filled frame and a mask with
+    # MEASURED, FILLED or MISSING for every value.
+    if df.empty:
+        return df.copy(), pd.DataFrame(MEASURED, index=df.index, columns=df.columns, dtype=np.int8)
+
+    # Pad to whole days and reshape to (days, 24, columns)
+    lead = df.index[0].hour
+    n = len(df)
+    days = -(-(lead + n) // 24)
+    values = np.full((days * 24, df.shape[1]), np.nan)
+    values[lead:lead + n] = df.to_numpy(dtype=float)
+    values = values.reshape(days, 24, -1)
+    valid = ~np.isnan(values)
+
+    # Index of the last valid day at or before, and the first at or after, every day
+    day = np.arange(days)[:, None, None]
+    prev_day = np.maximum.accumulate(np.where(valid, day, -1), axis=0)
+    next_day = np.minimum.accumulate(np.where(valid, day, days)[::-1], axis=0)[::-1]
+    prev_gap = np.where(prev_day >= 0, day - prev_day, days)
+    next_gap = np.where(next_day < days, next_day - day, days)
+
+    use_prev = prev_gap <= next_gap
+    source = np.where(use_prev, prev_day, next_day)
+    fill = ~valid & (np.minimum(prev_gap, next_gap) <= max_days)
+    candidates = np.take_along_axis(values, np.clip(source, 0, days - 1), axis=0)
+    filled = np.where(fill, candidates, values)
+
+    mask = np.where(valid, MEASURED, np.where(fill, FILLED, MISSING)).astype(np.int8)
+    filled = filled.reshape(days * 24, -1)[lead:lead + n]
+    mask = mask.reshape(days * 24, -1)[lead:lead + n]
+    return (pd.DataFrame(filled, index=df.index, columns=df.columns),
+            pd.DataFrame(mask, index=df.index, columns=df.columns))
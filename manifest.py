@@ -0,0 +1,66 @@
+import os
+import json
+import hashlib
+
+# Manifest of generated artifacts. For every output file it records a hash of each
+# input file, the parameters used and a hash of the output itself, so a stage can
+# skip outputs whose inputs and parameters have not changed since the last run, and
+# an output that another script has overwritten since then is built again.
+
+MANIFEST_FILE = 'manifest.json'
+
+# Hashes already computed in this process, keyed on path, size and modification time
+_hashes = {}
+
+def file_hash(file_path, block_size=1 << 20):
+    stat = os.stat(file_path)
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+    if key in _hashes:
+        return _hashes[key]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    _hashes[key] = digest.hexdigest()
+    return _hashes[key]
+
+def params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_path):
+    # Write to a temporary file first so an interrupted run cannot corrupt the manifest
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_path, manifest_path)
+
+def _entry(inputs, params):
+    return {
+        'inputs': {os.path.abspath(p): file_hash(p) for p in inputs},
+        'params': params_hash(params),
+    }
+
+def is_up_to_date(manifest, outputs, inputs, params):
+    # True when every output exists unchanged and was built from the same inputs and parameters
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    if not all(os.path.exists(p) for p in outputs):
+        return False
+    if not all(os.path.exists(p) for p in inputs):
+        return False
+    entry = _entry(inputs, params)
+    return all(manifest.get(os.path.abspath(p)) == dict(entry, output=file_hash(p)) for p in outputs)
+
+def record(manifest, outputs, inputs, params):
+    # Call once the outputs have been written
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    entry = _entry(inputs, params)
+    for p in outputs:
+        manifest[os.path.abspath(p)] = dict(entry, output=file_hash(p))
@@ -0,0 +1,304 @@
+import argparse
+import multiprocessing
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from chart_options import CHART_FORMATS, HEATMAP_MODES
+from comfort import add_diagnostics_argument, print_solver_diagnostics
+from comfort_cache import DIAGNOSTIC_COLUMNS, add_comfort_columns, comfort_series
+from doorlog import detect_columns, door_params, door_series_frame, find_door_logs, output_files, read_door_hours, write_door_text_files
+from gap_fill import MAX_FILL_DAYS, fill_same_hour
+from manifest import MANIFEST_FILE, load_manifest, record, save_manifest
+from process_data import END_DATE, START_DATE, STORE_COLUMNS, ingest_params, ladybug_files, read_hourly_means, write_ladybug_files
+from run_report import measure, measured_call, run_settings, worker_result
+from sensor_stats import CO2_THRESHOLDS, PPD_THRESHOLDS
+from series_store import series_paths, write_series
+
+# In-memory pipeline: ingest -> gap fill -> PPD -> door merge -> statistics and
+# charts, run as one graph of stages. Every stage hands its DataFrames to the stages
+# that depend on it, so nothing is written to disk and read back in between; the
+# series store, Ladybug and door text files and the comfort cache are only written
+# when asked for. Stages whose inputs are ready run at the same time, so the charts
+# render while the statistics workbook is written. Files that are written are
+# recorded in the manifest with the settings process_data.py and doorlog.py use, so
+# those scripts see whether they are still up to date.
+
+# Intermediate files that can be written along the way
+INTERMEDIATES = ['store', 'ladybug', 'door', 'comfort']
+
+# Final outputs; each one only runs the stages it needs
+TARGETS = ['stats', 'charts']
+
+# Worker processes are started fresh instead of forked, because the stages that
+# start them run in threads
+POOL_CONTEXT = 'spawn'
+
+def worker_pool(jobs):
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context(POOL_CONTEXT))
+
+def read_export(base_name, path, start_date, end_date):
+    with measure('ingest', base_name) as timing:
+        hourly_df, timing['rows'] = read_hourly_means(path, start_date, end_date)
+    return hourly_df
+
+def export_file(context, base_name):
+    return os.path.join(context['input_folder'], f'{base_name}.csv')
+
+def ingest_stage(context):
+    # Hourly means of every Aranet export in the study period
+    csv_files = sorted(f for f in os.listdir(context['input_folder']) if f.endswith('.csv'))
+    base_names = [os.path.splitext(f)[0] for f in csv_files]
+    paths = [os.path.join(context['input_folder'], f) for f in csv_files]
+    start_date, end_date = context['start_date'], context['end_date']
+    if context['jobs'] <= 1:
+        hourly = [read_export(base_name, path, start_date, end_date) for base_name, path in zip(base_names, paths)]
+    else:
+        settings = run_settings()
+        with worker_pool(context['jobs']) as executor:
+            futures = [executor.submit(measured_call, settings, read_export, base_name, path, start_date, end_date)
+                       for base_name, path in zip(base_names, paths)]
+            hourly = [worker_result(future.result()) for future in futures]
+    print(f"Ingested {len(base_names)} exports")
+    return dict(zip(base_names, hourly))
+
+def gap_fill_stage(context, hourly):
+    # Fill missing hours and keep the store columns with their gap mask
+    frames = {}
+    for base_name, hourly_df in hourly.items():
+        with measure('gap_fill', base_name, len(hourly_df)):
+            hourly_df, gap_mask = fill_same_hour(hourly_df, MAX_FILL_DAYS)
+        if 'ladybug' in context['write']:
+            with measure('write_ladybug', base_name, len(hourly_df)):
+                write_ladybug_files(hourly_df, base_name, context['ladybug_folder'])
+            outputs = [f for files in ladybug_files(hourly_df.index, base_name, context['ladybug_folder']).values() for f in files.values()]
+            record(context['manifest'], outputs, [export_file(context, base_name)], context['ingest_params'])
+        frame = hourly_df[list(STORE_COLUMNS)].rename(columns=STORE_COLUMNS)
+        frame['gap_mask'] = gap_mask[list(STORE_COLUMNS)].max(axis=1)
+        frames[base_name] = frame
+    return frames
+
+def ppd_stage(context, frames):
+    for base_name, frame in frames.items():
+        with measure('ppd', base_name, len(frame)):
+            # PPD already in the comfort cache is reused; new results are only added to it with --write comfort
+            comfort = comfort_series(frame['temperature'].values, frame['humidity'].values, write_cache='comfort' in context['write'])
+        add_comfort_columns(frame, comfort)
+        if context['pmv_diagnostics']:
+            print_solver_diagnostics(base_name, comfort, frame.index)
+        if 'store' in context['write']:
+            with measure('write_store', base_name, len(frame)):
+                store_columns = ['temperature', 'humidity', 'co2', 'ppd', 'gap_mask'] + [c for c in DIAGNOSTIC_COLUMNS.values() if c in frame]
+                write_series(context['store_folder'], base_name, frame[store_columns])
+            record(context['manifest'], list(series_paths(context['store_folder'], base_name)), [export_file(context, base_name)],
+                   context['ingest_params'])
+    return frames
+
+def door_stage(context):
+    # Hourly door open data of every door log, keyed on the log's name
+    doors = {}
+    for door_file in context['door_files']:
+        door_name = os.path.splitext(os.path.basename(door_file))[0]
+        with measure('door', door_name) as timing:
+            datetime_column, motorseconds_column = detect_columns(door_file)
+            door_hourly, timing['rows'] = read_door_hours(door_file, datetime_column, motorseconds_column)[:2]
+        if 'door' in context['write']:
+            write_door_text_files(door_hourly, output_files(door_file, context['door_folder'], context['store_folder'])[1])
+            write_series(context['store_folder'], door_name, door_series_frame(door_hourly))
+            record(context['manifest'], output_files(door_file, context['door_folder'], context['store_folder'])[2], [door_file],
+                   door_params())
+        doors[door_name] = door_series_frame(door_hourly)
+    if context['door_files']:
+        print(f"Read {len(doors)} door logs")
+    return doors
+
+def merge_stage(context, frames, doors):
+    # A log named '<sensor>_door_logger' belongs to that sensor; door_open = 1 for open
+    # hours and NaN for hours the log does not cover
+    for base_name, frame in frames.items():
+        door = doors.get(f'{base_name}_door_logger')
+        if door is not None:
+            frame['door_open'] = door['door'].reindex(frame.index).astype(float)
+    return frames
+
+def stats_stage(context, frames):
+    from analysis import END_DATE, START_DATE, analyze_data, write_statistics_workbook
+    start_date, end_date = context['period'] or (START_DATE, END_DATE)
+
+    def results():
+        for base_name, frame in frames.items():
+            # Measured before the yield, so the time spent writing the rows is not counted
+            try:
+                with measure('analyze', base_name, len(frame)):
+                    result = analyze_data(frame, start_date, end_date, **context['thresholds'])
+            except Exception as e:
+                result = e
+            yield base_name, result
+
+    os.makedirs(context['output_folder'], exist_ok=True)
+    excel_file = os.path.join(context['output_folder'], 'all_sensors_statistics.xlsx')
+    if not write_statistics_workbook(excel_file, results(), context['thresholds'], context['output_folder']):
+        print("No valid data to create Excel file.")
+        return None
+    print(f"Excel file with statistics for all sensors has been saved: {excel_file}")
+    return excel_file
+
+def render_chart(base_name, frame, chart_folder, heatmap_mode, file_format, overlay_file, period=None):
+    # Sensors with door data get the door chart; the plotting stack is only imported here
+    from chart_common import use_agg_backend
+    use_agg_backend()
+    if 'door_open' in frame:
+        from chart_maker_door import END_DATE, START_DATE, render_sensor_chart
+    else:
+        from chart_maker import END_DATE, START_DATE, render_sensor_chart
+    start_date, end_date = period or (START_DATE, END_DATE)
+    with measure('chart', base_name, len(frame)):
+        return render_sensor_chart(base_name, None, None, chart_folder, heatmap_mode, file_format, overlay_file,
+                                   start_date=start_date, end_date=end_date, frame=frame)
+
+def charts_stage(context, frames):
+    os.makedirs(context['chart_folder'], exist_ok=True)
+    chart_args = (context['chart_folder'], context['heatmap'], context['format'], context['overlay_file'], context['period'])
+    chart_files = {}
+    failures = {}
+    if context['jobs'] <= 1:
+        for base_name, frame in frames.items():
+            try:
+                chart_files[base_name] = render_chart(base_name, frame, *chart_args)
+            except Exception as e:
+                failures[base_name] = str(e)
+    else:
+        settings = run_settings()
+        with worker_pool(context['jobs']) as executor:
+            futures = {base_name: executor.submit(measured_call, settings, render_chart, base_name, frame, *chart_args)
+                       for base_name, frame in frames.items()}
+            for base_name, future in futures.items():
+                try:
+                    chart_files[base_name] = worker_result(future.result())
+                except Exception as e:
+                    failures[base_name] = str(e)
+    print(f"{len(chart_files)} charts created, {len(failures)} failed.")
+    for base_name, error in failures.items():
+        print(f"  {base_name}: {error}")
+    return chart_files
+
+# Every stage with the stages whose results it takes, in that order
+STAGES = {
+    'ingest': ((), ingest_stage),
+    'gap_fill': (('ingest',), gap_fill_stage),
+    'ppd': (('gap_fill',), ppd_stage),
+    'door': ((), door_stage),
+    'merge': (('ppd', 'door'), merge_stage),
+    'stats': (('merge',), stats_stage),
+    'charts': (('merge',), charts_stage),
+}
+
+def required_stages(targets, stages=STAGES):
+    # The targets and every stage they depend on
+    required = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(stages[name][0])
+    return [name for name in stages if name in required]
+
+def result_rows(result):
+    # Rows of the DataFrames a stage returns, keyed on sensor
+    frames = [frame for frame in result.values() if hasattr(frame, 'columns')] if isinstance(result, dict) else []
+    return sum(len(frame) for frame in frames) if frames else None
+
+def measured_stage(stage, context, *inputs):
+    # Whole stages are recorded under their function name, apart from the per-sensor
+    # records made inside them
+    with measure(stage.__name__) as timing:
+        result = stage(context, *inputs)
+        timing['rows'] = result_rows(result)
+    return result
+
+def run_stages(context, targets, stages=STAGES):
+    # Run the stages the targets need, each as soon as its dependencies have finished,
+    # with independent stages in parallel threads. Returns the result of every stage.
+    needed = required_stages(targets, stages)
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(needed)) as executor:
+        while len(results) < len(needed):
+            for name in needed:
+                dependencies, stage = stages[name]
+                if name in results or name in running.values() or not all(d in results for d in dependencies):
+                    continue
+                running[executor.submit(measured_stage, stage, context, *(results[d] for d in dependencies))] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Run ingest, gap filling, PPD, door merge, statistics and charts in memory.')
+    parser.add_argument('--start-date', help=f'First day of the study period (YYYY-MM-DD, default {START_DATE})')
+    parser.add_argument('--end-date', help=f'Last day of the study period (YYYY-MM-DD, default {END_DATE})')
+    parser.add_argument('--door-logs', nargs='*', default=[], help='Door logger CSV files or folders of them')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS, help='Outputs to create')
+    parser.add_argument('--write', nargs='+', choices=INTERMEDIATES, default=[], help='Also write these intermediate files')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of worker processes used for reading exports and rendering charts')
+    parser.add_argument('--heatmap', choices=HEATMAP_MODES, default='vector', help='Draw the PPD heatmap as vector cells or as one rasterized image')
+    parser.add_argument('--format', choices=CHART_FORMATS, default='pdf', help='File format of the charts')
+    parser.add_argument('--ppd-thresholds', type=float, nargs='+', default=PPD_THRESHOLDS, help='Report the percentage of hours with PPD at or below each value')
+    parser.add_argument('--co2-thresholds', type=float, nargs='+', default=CO2_THRESHOLDS, help='Report the percentage of hours with CO2 above each value (ppm)')
+    add_diagnostics_argument(parser)
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    input_folder = os.path.join(script_dir, 'input_csv')
+    if not os.path.exists(input_folder):
+        print(f"Error: Input folder '{input_folder}' does not exist.")
+        sys.exit(1)
+
+    # Without --start-date and --end-date every stage uses the study period of its own
+    # script; with them, the statistics and charts cover the period that was ingested
+    start_date = args.start_date or START_DATE
+    end_date = args.end_date or END_DATE
+    period = (start_date, end_date) if args.start_date or args.end_date else None
+
+    overlay_file = os.path.join(script_dir, 'charts', 'overlay.pdf')
+    manifest_path = os.path.join(script_dir, MANIFEST_FILE)
+    context = {
+        'input_folder': input_folder,
+        'door_files': find_door_logs(args.door_logs),
+        'start_date': start_date,
+        'end_date': end_date,
+        'period': period,
+        'store_folder': os.path.join(script_dir, 'output_store'),
+        'ladybug_folder': os.path.join(script_dir, 'output_ladybug'),
+        'door_folder': os.path.join(script_dir, 'output_ladybug'),
+        'output_folder': os.path.join(script_dir, 'output'),
+        'chart_folder': os.path.join(script_dir, 'charts'),
+        'write': set(args.write),
+        'jobs': args.jobs,
+        'heatmap': args.heatmap,
+        'format': args.format,
+        'overlay_file': overlay_file if os.path.exists(overlay_file) else None,
+        'pmv_diagnostics': args.pmv_diagnostics,
+        'manifest': load_manifest(manifest_path),
+        'ingest_params': ingest_params(start_date, end_date),
+        'thresholds': {'ppd_thresholds': args.ppd_thresholds, 'co2_thresholds': args.co2_thresholds},
+    }
+    if 'ladybug' in context['write']:
+        os.makedirs(context['ladybug_folder'], exist_ok=True)
+    if 'door' in context['write']:
+        os.makedirs(context['door_folder'], exist_ok=True)
+
+    # A failed stage exits with status 1, so scheduled runs notice it
+    try:
+        run_stages(context, args.targets)
+    except Exception as e:
+        print(f"Error running the pipeline: {str(e)}")
+        sys.exit(1)
+    finally:
+        # The files written before a failure are recorded as well
+        if context['write']:
+            save_manifest(context['manifest'], manifest_path)
+
+if __name__ == "__main__":
+    main()
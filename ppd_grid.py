@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+import numpy as np
+import comfort
+from comfort import AIR_SPEED, CLOTHING_LEVEL, METABOLIC_RATE, EXTERNAL_WORK, calculate_ppd_from_temp_rh
+
+# PPD surrogate: once the comfort parameters are fixed, PPD only depends on
+# temperature and relative humidity, so it can be tabulated on a dense grid once
+# and looked up with bilinear interpolation instead of running the PMV solver.
+
+# Default grid covers the range seen by the loggers; readings outside it fall back
+# to the exact solver.
+TEMPERATURE_RANGE = (-10.0, 50.0, 0.05)  # start, stop, step in °C
+HUMIDITY_RANGE = (0.0, 100.0, 0.25)  # start, stop, step in %
+MAX_ERROR = 0.5  # maximum allowed PPD error in percentage points
+
+CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+
+_grids = {}
+
+def grid_key(air_speed=AIR_SPEED, clothing_level=CLOTHING_LEVEL, metabolic_rate=METABOLIC_RATE,
+             external_work=EXTERNAL_WORK, temperature_range=TEMPERATURE_RANGE, humidity_range=HUMIDITY_RANGE):
+    params = {
+        'air_speed': air_speed,
+        'clothing_level': clothing_level,
+        'metabolic_rate': metabolic_rate,
+        'external_work': external_work,
+        'temperature_range': list(temperature_range),
+        'humidity_range': list(humidity_range),
+        # Read when called, so a solver chosen at runtime gets its own grid
+        'solver': comfort.PMV_SOLVER,
+    }
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+def _axis(start, stop, step):
+    return np.linspace(start, stop, int(round((stop - start) / step)) + 1)
+
+def build_ppd_grid(air_speed=AIR_SPEED, clothing_level=CLOTHING_LEVEL, metabolic_rate=METABOLIC_RATE,
+                   external_work=EXTERNAL_WORK, temperature_range=TEMPERATURE_RANGE, humidity_range=HUMIDITY_RANGE):
+    temperatures = _axis(*temperature_range)
+    humidities = _axis(*humidity_range)
+    ppd = calculate_ppd_from_temp_rh(temperatures[:, None], humidities[None, :],
+                                     air_speed, clothing_level, metabolic_rate, external_work, use_grid=False)
+    return {
+        'temperature': temperatures,
+        'humidity': humidities,
+        'ppd': ppd,
+        'params': (air_speed, clothing_level, metabolic_rate, external_work),
+    }
+
+def load_ppd_grid(air_speed=AIR_SPEED, clothing_level=CLOTHING_LEVEL, metabolic_rate=METABOLIC_RATE,
+                  external_work=EXTERNAL_WORK, temperature_range=TEMPERATURE_RANGE, humidity_range=HUMIDITY_RANGE,
+                  max_error=MAX_ERROR, cache_folder=CACHE_FOLDER):
+    # Return the grid for this parameter set from memory, then disk, building it if needed
+    key = grid_key(air_speed, clothing_level, metabolic_rate, external_work, temperature_range, humidity_range)
+    if key in _grids:
+        return _grids[key]
+
+    cache_file = os.path.join(cache_folder, f'ppd_grid_{key}.npz')
+    if os.path.exists(cache_file):
+        with np.load(cache_file) as data:
+            grid = {
+                'temperature': data['temperature'],
+                'humidity': data['humidity'],
+                'ppd': data['ppd'],
+                'params': tuple(data['params']),
+            }
+    else:
+        grid = build_ppd_grid(air_speed, clothing_level, metabolic_rate, external_work, temperature_range, humidity_range)
+        if max_error is not None:
+            check_grid_error(grid, max_error)
+        os.makedirs(cache_folder, exist_ok=True)
+        np.savez(cache_file, temperature=grid['temperature'], humidity=grid['humidity'],
+                 ppd=grid['ppd'], params=np.array(grid['params'], dtype=float))
+
+    _grids[key] = grid
+    return grid
+
+def interpolate_ppd(grid, temperature, relative_humidity):
+    temperature, relative_humidity = np.broadcast_arrays(np.asarray(temperature, dtype=float),
+                                                         np.asarray(relative_humidity, dtype=float))
+    t_axis, rh_axis, table = grid['temperature'], grid['humidity'], grid['ppd']
+
+    # Fractional grid positions; the axes are uniform so this is a multiply, not a search
+    ti = (temperature - t_axis[0]) / (t_axis[1] - t_axis[0])
+    hi = (relative_humidity - rh_axis[0]) / (rh_axis[1] - rh_axis[0])
+    inside = (ti >= 0) & (ti <= len(t_axis) - 1) & (hi >= 0) & (hi <= len(rh_axis) - 1)
+
+    t0 = np.clip(np.floor(np.where(inside, ti, 0)).astype(np.intp), 0, len(t_axis) - 2)
+    h0 = np.clip(np.floor(np.where(inside, hi, 0)).astype(np.intp), 0, len(rh_axis) - 2)
+    ft = np.where(inside, ti, 0) - t0
+    fh = np.where(inside, hi, 0) - h0
+    ppd = ((1 - ft) * (1 - fh) * table[t0, h0] + ft * (1 - fh) * table[t0 + 1, h0]
+           + (1 - ft) * fh * table[t0, h0 + 1] + ft * fh * table[t0 + 1, h0 + 1])
+
+    # Readings outside the grid (and NaNs) go through the exact solver
+    outside = ~inside
+    if outside.any():
+        ppd = np.array(ppd)
+        ppd[outside] = calculate_ppd_from_temp_rh(temperature[outside], relative_humidity[outside], *grid['params'],
+                                                  use_grid=False)
+    return ppd
+
+def check_grid_error(grid, max_error=MAX_ERROR, samples=20000, seed=0):
+    # Compare the interpolated PPD with the exact solver at random points inside the grid
+    rng = np.random.default_rng(seed)
+    temperature = rng.uniform(grid['temperature'][0], grid['temperature'][-1], samples)
+    relative_humidity = rng.uniform(grid['humidity'][0], grid['humidity'][-1], samples)
+    exact = calculate_ppd_from_temp_rh(temperature, relative_humidity, *grid['params'], use_grid=False)
+    error = np.max(np.abs(interpolate_ppd(grid, temperature, relative_humidity) - exact))
+    if error > max_error:
+        raise ValueError(f"PPD grid error {error:.4f} exceeds the allowed maximum of {max_error}")
+    return error
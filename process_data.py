@@ -1,65 +1,180 @@
+import argparse
 import os
 import pandas as pd
 import numpy as np
+from gap_fill import FILLED, MISSING, MAX_FILL_DAYS, fill_same_hour
+from comfort import add_diagnostics_argument, comfort_params, print_solver_diagnostics
+from comfort_cache import add_comfort_columns, compute_comfort
+from manifest import MANIFEST_FILE, is_up_to_date, load_manifest, record, save_manifest
+from run_report import measure
+from series_store import ladybug_year_files, series_paths, to_ladybug_year, write_series
 
-input_folder = os.path.join(os.getcwd(), 'input_csv')
-output_folder = os.path.join(os.getcwd(), 'output_ladybug')
-os.makedirs(output_folder, exist_ok=True)
+DATETIME_COLUMN = 'datetime(UTC+02)'
+DATETIME_FORMAT = '%Y.%m.%d %H:%M:%S'
 
-csv_files = [f for f in os.listdir(input_folder) if f.endswith('.csv')]
+# Study period, change depending on the period you want to analyse
+START_DATE = '2024-04-23'
+END_DATE = '2024-06-09'
 
-def fill_missing_with_previous_day(df):
-    for column in df.columns:
-        mask = df[column].isna()
-        df.loc[mask, column] = df[column].shift(24)
-    return df
+# Aranet column names and their names in the binary series store
+STORE_COLUMNS = {
+    'temperature(C)': 'temperature',
+    'humidity(%)': 'humidity',
+    'co2(ppm)': 'co2',
+}
+
+# Also write the one-value-per-line Ladybug text files next to the binary store
+WRITE_LADYBUG = True
+
+# Number of CSV rows held in memory at a time while reading an Aranet export
+CHUNK_SIZE = 100000
 
 def create_ladybug_file(data, column_name, output_file):
     with open(output_file, 'w') as f:
         for value in data[column_name]:
             f.write(f"{value}\n")
 
-for file in csv_files:
-    file_path = os.path.join(input_folder, file)
-    df = pd.read_csv(file_path, sep=';', skiprows=1)
-    
-    df['datetime(UTC+02)'] = pd.to_datetime(df['datetime(UTC+02)'], format='%Y.%m.%d %H:%M:%S')
-    df.set_index('datetime(UTC+02)', inplace=True)
-    
-    # Remove February 29th
-    df = df[~((df.index.month == 2) & (df.index.day == 29))]
-    
-    start_date = '2024-04-23'
-    end_date = '2024-06-09'
-    filtered_df = df[start_date:end_date]
-    
-    # Resample to hourly data
-    hourly_df = filtered_df.resample('H').mean()
-    
-    # Fill missing data with values from the previous day
-    hourly_df = fill_missing_with_previous_day(hourly_df)
-    
-    # Generate a full year's hourly timestamps without February 29th
-    full_year = pd.date_range(start='2024-01-01', end='2024-12-31 23:00:00', freq='H')
-    full_year = full_year[~((full_year.month == 2) & (full_year.day == 29))]
-    
-    # Reindex to full year, filling missing values with data from the same hour of the previous day
-    hourly_avg_full = hourly_df.reindex(full_year)
-    hourly_avg_full = fill_missing_with_previous_day(hourly_avg_full)
-    
-    # Fill any remaining NaN values with 0
-    hourly_avg_full = hourly_avg_full.fillna(0)
-    
-    base_name = os.path.splitext(file)[0]
-    create_ladybug_file(hourly_avg_full, 'temperature(C)', os.path.join(output_folder, f'{base_name}_temperature_ladybug.txt'))
-    create_ladybug_file(hourly_avg_full, 'humidity(%)', os.path.join(output_folder, f'{base_name}_humidity_ladybug.txt'))
-    create_ladybug_file(hourly_avg_full, 'co2(ppm)', os.path.join(output_folder, f'{base_name}_co2_ladybug.txt'))
-
-print(f"Ladybug input files have been created in the {output_folder} folder.")
-
-# Verify the number of lines in each output file
-for output_file in os.listdir(output_folder):
-    file_path = os.path.join(output_folder, output_file)
-    with open(file_path, 'r') as f:
-        line_count = sum(1 for line in f)
-    print(f"{output_file}: {line_count} lines")
\ No newline at end of file
+def study_hours(start_date, end_date):
+    # Every hour of the study period, leap days included
+    return pd.date_range(start=start_date, end=pd.Timestamp(end_date) + pd.Timedelta(hours=23), freq='H')
+
+def read_hourly_means(file_path, start_date, end_date, chunksize=CHUNK_SIZE):
+    # Stream the export in chunks and keep running hourly sums and counts per column,
+    # so peak memory depends on the study window and not on the size of the file.
+    # Returns the hourly means and the number of CSV rows read.
+    hours = study_hours(start_date, end_date)
+    window_start = hours[0]
+    window_end = hours[-1] + pd.Timedelta(hours=1)
+
+    # The timestamps are zero-padded, so rows outside the window can be dropped by
+    # comparing the raw strings before anything is parsed
+    first = window_start.strftime(DATETIME_FORMAT)
+    last = window_end.strftime(DATETIME_FORMAT)
+
+    columns = None
+    sums = counts = None
+    rows = 0
+    for chunk in pd.read_csv(file_path, sep=';', skiprows=1, chunksize=chunksize):
+        rows += len(chunk)
+        if columns is None:
+            columns = [c for c in chunk.columns if c != DATETIME_COLUMN]
+            sums = np.zeros((len(hours), len(columns)))
+            counts = np.zeros((len(hours), len(columns)))
+
+        stamps = chunk[DATETIME_COLUMN].astype(str)
+        chunk = chunk[(stamps >= first) & (stamps < last)]
+        if chunk.empty:
+            continue
+
+        times = pd.to_datetime(chunk[DATETIME_COLUMN], format=DATETIME_FORMAT)
+        slots = ((times - window_start) // pd.Timedelta(hours=1)).to_numpy()
+        values = chunk[columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+        valid = ~np.isnan(values)
+        for i in range(len(columns)):
+            sums[:, i] += np.bincount(slots, weights=np.where(valid[:, i], values[:, i], 0), minlength=len(hours))
+            counts[:, i] += np.bincount(slots, weights=valid[:, i], minlength=len(hours))
+
+    if columns is None:
+        return pd.DataFrame(index=hours), rows
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return pd.DataFrame(means, index=hours, columns=columns), rows
+
+def ladybug_files(hours, base_name, output_folder):
+    # Ladybug files per column and year for a study period
+    return {column: ladybug_year_files(os.path.join(output_folder, f'{base_name}_{kind}_ladybug.txt'), hours)
+            for column, kind in STORE_COLUMNS.items()}
+
+def write_ladybug_files(hourly_df, base_name, output_folder):
+    # Ladybug needs a number for every hour of a year without February 29th, so the
+    # hourly data is written as one file per year. Hours outside the study period and
+    # hours that could not be filled are written as 0.
+    for column, files in ladybug_files(hourly_df.index, base_name, output_folder).items():
+        for year, output_file in files.items():
+            create_ladybug_file(to_ladybug_year(hourly_df, year), column, output_file)
+
+def ingest_params(start_date, end_date):
+    # Settings the store and Ladybug files of an export depend on, in the manifest
+    return {'stage': 'process_data', 'start_date': start_date, 'end_date': end_date, 'max_fill_days': MAX_FILL_DAYS,
+            'comfort': comfort_params()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Create hourly series and Ladybug files from Aranet CSV exports.')
+    parser.add_argument('--start-date', default=START_DATE, help='First day of the study period (YYYY-MM-DD)')
+    parser.add_argument('--end-date', default=END_DATE, help='Last day of the study period (YYYY-MM-DD); it may be years after the start')
+    parser.add_argument('--force', action='store_true', help='Process every export, even if it has not changed')
+    add_diagnostics_argument(parser)
+    args = parser.parse_args()
+
+    input_folder = os.path.join(os.getcwd(), 'input_csv')
+    output_folder = os.path.join(os.getcwd(), 'output_ladybug')
+    store_folder = os.path.join(os.getcwd(), 'output_store')
+    os.makedirs(output_folder, exist_ok=True)
+
+    csv_files = [f for f in os.listdir(input_folder) if f.endswith('.csv')]
+
+    # Skip exports that have not changed since they were last processed with the same settings
+    manifest_path = os.path.join(os.getcwd(), MANIFEST_FILE)
+    manifest = load_manifest(manifest_path)
+    params = ingest_params(args.start_date, args.end_date)
+
+    hours = study_hours(args.start_date, args.end_date)
+    for file in csv_files:
+        file_path = os.path.join(input_folder, file)
+        base_name = os.path.splitext(file)[0]
+        outputs = list(series_paths(store_folder, base_name))
+        if WRITE_LADYBUG:
+            outputs += [f for files in ladybug_files(hours, base_name, output_folder).values() for f in files.values()]
+        if not args.force and is_up_to_date(manifest, outputs, [file_path], params):
+            print(f"{file} is up to date")
+            continue
+
+        # Read the export and resample to hourly data in one streaming pass
+        with measure('ingest', base_name) as timing:
+            hourly_df, timing['rows'] = read_hourly_means(file_path, args.start_date, args.end_date)
+
+        # Fill missing data from the same hour of the nearest day with data
+        with measure('gap_fill', base_name, len(hourly_df)):
+            hourly_df, gap_mask = fill_same_hour(hourly_df, MAX_FILL_DAYS)
+
+        # Store the study window with its timestamps, the derived PPD and the PMV
+        # solver's iteration counts and convergence flags. Hours that could not be
+        # filled stay NaN, and gap_mask records per hour whether the values were
+        # measured, filled or are still missing.
+        series = hourly_df[list(STORE_COLUMNS)].rename(columns=STORE_COLUMNS)
+        with measure('ppd', base_name, len(series)):
+            comfort = compute_comfort(series['temperature'].values, series['humidity'].values)
+        add_comfort_columns(series, comfort)
+        if args.pmv_diagnostics:
+            print_solver_diagnostics(base_name, comfort, series.index)
+        series['gap_mask'] = gap_mask[list(STORE_COLUMNS)].max(axis=1)
+        filled_hours = (series['gap_mask'] == FILLED).sum()
+        missing_hours = (series['gap_mask'] == MISSING).sum()
+        if filled_hours or missing_hours:
+            print(f"{file}: {filled_hours} hours filled, {missing_hours} hours still missing")
+        with measure('write_store', base_name, len(series)):
+            write_series(store_folder, base_name, series)
+
+        if WRITE_LADYBUG:
+            with measure('write_ladybug', base_name, len(hourly_df)):
+                write_ladybug_files(hourly_df, base_name, output_folder)
+        record(manifest, outputs, [file_path], params)
+
+    save_manifest(manifest, manifest_path)
+
+    print(f"Hourly series have been stored in the {store_folder} folder.")
+    if not WRITE_LADYBUG:
+        return
+    print(f"Ladybug input files have been created in the {output_folder} folder.")
+
+    # Verify the number of lines in each output file
+    for output_file in os.listdir(output_folder):
+        file_path = os.path.join(output_folder, output_file)
+        with open(file_path, 'r') as f:
+            line_count = sum(1 for line in f)
+        print(f"{output_file}: {line_count} lines")
+
+if __name__ == "__main__":
+    main()
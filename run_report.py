@@ -0,0 +1,187 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Timing and memory of the stages of a run. A stage is any block wrapped in measure();
+# each call records its wall time, the CPU time of its thread, the peak resident
+# memory of the process so far, the peak traced Python memory (with trace_memory)
+# and a row count, per sensor where there is one. Nothing is recorded until
+# start_run() is called, so the scripts pay almost nothing when they are run without
+# a report. finish_run() writes the records as one JSON report.
+#
+# Stages that run at the same time in threads share the traced memory peak, so
+# their memory figures overlap.
+
+# Default cProfile output file, '{stage}' is replaced with the profiled stage
+PROFILE_FILE = 'profile_{stage}.prof'
+
+_run = None
+_lock = threading.Lock()
+_local = threading.local()
+
+def start_run(command=None, profile_stage=None, profile_file=None, trace_memory=False):
+    # Start recording; profile_stage names the stage whose calls go into one cProfile dump
+    global _run
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _run = {
+        'command': command,
+        'argv': list(sys.argv),
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'pid': os.getpid(),
+        'wall_start': time.perf_counter(),
+        'cpu_start': time.process_time(),
+        'trace_memory': trace_memory,
+        'profile_stage': profile_stage,
+        'profile_file': (profile_file or PROFILE_FILE).format(stage=profile_stage) if profile_stage else None,
+        'profiler': cProfile.Profile() if profile_stage else None,
+        'records': [],
+    }
+    return _run
+
+def run_settings():
+    # What a worker process needs to record the same way, or None without a run
+    if _run is None:
+        return None
+    return {'profile_stage': _run['profile_stage'], 'profile_file': _run['profile_file'], 'trace_memory': _run['trace_memory']}
+
+def peak_rss_mb(who=None):
+    # Peak resident memory of this process (or of its finished children) in MB
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+@contextmanager
+def measure(stage, sensor=None, rows=None):
+    # Record one call of a stage. The yielded dict may be updated, for example with
+    # the number of rows once it is known.
+    record = {'stage': stage, 'sensor': sensor, 'rows': rows}
+    if _run is None or _run['pid'] != os.getpid():
+        yield record
+        return
+
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    if _run['trace_memory']:
+        # Hand the peak so far to the enclosing stage before resetting it for this one
+        if stack:
+            stack[-1]['child_peak'] = max(stack[-1]['child_peak'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    frame = {'child_peak': 0}
+    stack.append(frame)
+
+    profiler = _run['profiler'] if stage == _run['profile_stage'] and not getattr(_local, 'profiling', False) else None
+    if profiler is not None:
+        _local.profiling = True
+        profiler.enable()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+        record['cpu_seconds'] = round(time.thread_time() - cpu_start, 6)
+        if profiler is not None:
+            profiler.disable()
+            _local.profiling = False
+        stack.pop()
+        record['peak_rss_mb'] = peak_rss_mb()
+        if _run['trace_memory']:
+            peak = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+            record['traced_peak_mb'] = round(peak / 2**20, 3)
+            if stack:
+                stack[-1]['child_peak'] = max(stack[-1]['child_peak'], peak)
+        record['pid'] = os.getpid()
+        record['offset_seconds'] = round(wall_start - _run['wall_start'], 6)
+        with _lock:
+            _run['records'].append(record)
+
+def add_records(records):
+    # Records made in a worker process
+    if _run is not None:
+        with _lock:
+            _run['records'].extend(records)
+
+def measured_call(settings, function, *args):
+    # Run function in a worker process and return its result with the records its
+    # measure() blocks made. With settings None nothing is recorded.
+    if settings is None:
+        return function(*args), []
+    if _run is None or _run['pid'] != os.getpid():
+        # A forked worker inherits the state of the thread that forked it
+        _local.stack = []
+        _local.profiling = False
+        start_run(profile_stage=settings['profile_stage'], trace_memory=settings['trace_memory'],
+                  profile_file=f"{settings['profile_file']}.{os.getpid()}" if settings['profile_file'] else None)
+    _run['records'] = []
+    result = function(*args)
+    if _run['profiler'] is not None and _run['profiler'].getstats():
+        # Every worker keeps adding to its own profile file
+        _run['profiler'].dump_stats(_run['profile_file'])
+    return result, _run['records']
+
+def worker_result(value):
+    # Keep the records of a measured_call and return its result
+    result, records = value
+    add_records(records)
+    return result
+
+def stage_totals(records):
+    # Calls, wall and CPU seconds and rows per stage
+    totals = {}
+    for record in records:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows': 0})
+        total['calls'] += 1
+        total['wall_seconds'] = round(total['wall_seconds'] + record['wall_seconds'], 6)
+        total['cpu_seconds'] = round(total['cpu_seconds'] + record['cpu_seconds'], 6)
+        total['rows'] += record['rows'] or 0
+    return totals
+
+def finish_run(report_file):
+    # Write the JSON run report and the profile, and stop recording
+    global _run
+    if _run is None:
+        return None
+    run = _run
+    _run = None
+    records = sorted(run['records'], key=lambda r: (r['offset_seconds'], r['pid']))
+    report = {
+        'command': run['command'],
+        'argv': run['argv'],
+        'started': run['started'],
+        'wall_seconds': round(time.perf_counter() - run['wall_start'], 6),
+        'cpu_seconds': round(time.process_time() - run['cpu_start'], 6),
+        'peak_rss_mb': peak_rss_mb(),
+        'children_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN) if resource is not None else None,
+        'trace_memory': run['trace_memory'],
+        'profile': None,
+        'totals': stage_totals(records),
+        'stages': records,
+    }
+    if run['trace_memory']:
+        report['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 3)
+        tracemalloc.stop()
+    if run['profiler'] is not None:
+        # Stages that ran in worker processes were profiled into a file per worker
+        profile_files = [f"{run['profile_file']}.{pid}" for pid in sorted({r['pid'] for r in records} - {run['pid']})]
+        if run['profiler'].getstats():
+            run['profiler'].dump_stats(run['profile_file'])
+            profile_files.insert(0, run['profile_file'])
+        report['profile'] = {'stage': run['profile_stage'], 'files': [f for f in profile_files if os.path.exists(f)]}
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
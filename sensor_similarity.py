@@ -0,0 +1,64 @@
+import numpy as np
+from scipy.cluster.hierarchy import leaves_list, linkage
+from scipy.spatial.distance import squareform
+
+# All-pairs comparison of sensors. Each variable is one (sensors, hours) array with
+# NaN for missing hours. Every pair is compared over the hours both sensors have,
+# and all the sums this needs come from a few matrix products of the values with the
+# mask of valid hours, instead of one pandas .corr call per pair.
+
+# Pairs with fewer common hours than this get no correlation or distance
+MIN_OVERLAP_HOURS = 24
+
+def pair_sums(data):
+    # Sums over the common hours of every pair (i, j): number of hours, sum of x_i,
+    # sum of x_i squared and sum of x_i * x_j. Sums of x_j are the transposes.
+    valid = ~np.isnan(data)
+    mask = valid.astype(float)
+    # Centre every sensor first so the sums of squares keep their precision
+    with np.errstate(invalid='ignore'):
+        centred = np.where(valid, data - np.nanmean(np.where(valid, data, np.nan), axis=1, keepdims=True), 0)
+    count = mask @ mask.T
+    sum_x = centred @ mask.T
+    sum_xx = (centred * centred) @ mask.T
+    sum_xy = centred @ centred.T
+    return np.round(count), sum_x, sum_xx, sum_xy
+
+def correlation_matrix(data, min_overlap=MIN_OVERLAP_HOURS):
+    # Pearson correlation of every pair of sensors over their common hours
+    count, sum_x, sum_xx, sum_xy = pair_sums(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covariance = count * sum_xy - sum_x * sum_x.T
+        variance = (count * sum_xx - sum_x * sum_x) * (count * sum_xx.T - sum_x.T * sum_x.T)
+        correlation = covariance / np.sqrt(np.where(variance > 0, variance, np.nan))
+    return np.where(count >= min_overlap, np.clip(correlation, -1, 1), np.nan)
+
+def distance_matrix(data, min_overlap=MIN_OVERLAP_HOURS):
+    # Root mean square difference of every pair of sensors over their common hours,
+    # in the unit of the data
+    valid = ~np.isnan(data)
+    mask = valid.astype(float)
+    # Differences do not change when every sensor has the same value subtracted at an
+    # hour, so take off the mean of each hour first and keep the squares small
+    reference = np.where(valid, data, 0).sum(axis=0) / np.maximum(mask.sum(axis=0), 1)
+    filled = np.where(valid, data - reference, 0)
+    count = np.round(mask @ mask.T)
+    squares = (filled * filled) @ mask.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_square = (squares + squares.T - 2 * filled @ filled.T) / count
+    distance = np.sqrt(np.maximum(mean_square, 0))
+    # Rounding would leave a small distance of a sensor to itself
+    np.fill_diagonal(distance, 0)
+    return np.where(count >= min_overlap, distance, np.nan)
+
+def cluster_order(correlation):
+    # Order of the sensors from average-linkage clustering on 1 - correlation, so
+    # similar sensors end up next to each other. Pairs without a correlation are
+    # treated as unrelated.
+    if len(correlation) < 3:
+        return np.arange(len(correlation))
+    distance = 1 - np.nan_to_num(correlation, nan=0)
+    distance = (distance + distance.T) / 2
+    np.fill_diagonal(distance, 0)
+    tree = linkage(squareform(np.clip(distance, 0, 2), checks=False), method='average', optimal_ordering=True)
+    return leaves_list(tree)
@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+from gap_fill import FILLED, MISSING
+
+# Statistics of hourly sensor data per group of hours (hour of day, day, week or the
+# whole window). Every statistic of a column is computed in one grouped pass: the
+# group of each hour is factorised once, counts, sums and threshold exceedances are
+# bincounts over the group codes, and min, max and quantiles come from one sort by
+# group and value.
+
+STAT_COLUMNS = ['temperature', 'humidity', 'co2', 'ppd']
+QUANTILES = [0.25, 0.5, 0.75]
+
+# Percentage of hours with PPD at or below each threshold (comfortable hours)
+PPD_THRESHOLDS = [20, 50]
+# Percentage of hours with CO2 above each threshold in ppm
+CO2_THRESHOLDS = [530, 700]
+
+GROUPINGS = ['hour', 'day', 'week']
+
+def group_codes(index, by=None):
+    # Group code of every hour and the label of every group
+    if by is None:
+        return np.zeros(len(index), dtype=np.int64), pd.Index(['all'])
+    if by == 'hour':
+        keys = index.hour
+    elif by == 'day':
+        keys = index.normalize()
+    elif by == 'week':
+        # Weeks start on Monday
+        keys = (index - pd.to_timedelta(index.dayofweek, unit='D')).normalize()
+    else:
+        raise ValueError(f"Unknown grouping: {by}")
+    codes, labels = pd.factorize(keys, sort=True)
+    return codes, pd.Index(labels, name=by)
+
+def column_stats(values, codes, groups, quantiles=QUANTILES):
+    # Count, mean, standard deviation, min, max and quantiles of one column per group;
+    # NaN values are left out
+    valid = ~np.isnan(values)
+    codes = codes[valid]
+    values = values[valid]
+    count = np.bincount(codes, minlength=groups)
+    has_data = count > 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(codes, weights=values, minlength=groups) / count
+        deviation = values - mean[codes]
+        variance = np.bincount(codes, weights=deviation * deviation, minlength=groups) / (count - 1)
+    stats = {
+        'count': count,
+        'mean': mean,
+        'std': np.where(count > 1, np.sqrt(np.maximum(variance, 0)), np.nan),
+    }
+
+    # Values sorted by group and then by value; a NaN at the end keeps empty groups in range
+    ordered = np.append(values[np.lexsort((values, codes))], np.nan)
+    first = np.cumsum(count) - count
+    last = np.where(has_data, first + count - 1, first)
+    stats['min'] = np.where(has_data, ordered[first], np.nan)
+    stats['max'] = np.where(has_data, ordered[last], np.nan)
+    for q in quantiles:
+        # Linear interpolation between the two closest ranks, like numpy's default
+        position = q * np.maximum(count - 1, 0)
+        below = np.floor(position).astype(np.int64)
+        above = np.ceil(position).astype(np.int64)
+        low = ordered[first + below]
+        high = ordered[first + above]
+        stats[f'q{q * 100:g}'] = np.where(has_data, low + (high - low) * (position - below), np.nan)
+    return stats, codes, values, count
+
+def exceedance_percentage(selected, codes, count, groups):
+    # Percentage of the hours with data in each group for which selected is True
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.bincount(codes, weights=selected, minlength=groups) / count * 100
+
+def grouped_stats(df, by=None, columns=STAT_COLUMNS, quantiles=QUANTILES,
+                  ppd_thresholds=PPD_THRESHOLDS, co2_thresholds=CO2_THRESHOLDS):
+    # One row per group of hours with '<column>_<stat>' columns, the PPD comfort and
+    # CO2 exceedance percentages, and the share of filled and missing hours when the
+    # frame has a gap mask
+    codes, labels = group_codes(df.index, by)
+    groups = len(labels)
+    result = {'hours': np.bincount(codes, minlength=groups)}
+
+    for column in columns:
+        if column not in df:
+            continue
+        stats, valid_codes, values, count = column_stats(df[column].to_numpy(dtype=float), codes, groups, quantiles)
+        for name, value in stats.items():
+            result[f'{column}_{name}'] = value
+        if column == 'ppd':
+            for threshold in ppd_thresholds:
+                result[f'comfort_percentage_{threshold:g}'] = exceedance_percentage(values <= threshold, valid_codes, count, groups)
+        if column == 'co2':
+            for threshold in co2_thresholds:
+                result[f'high_co2_percentage_{threshold:g}'] = exceedance_percentage(values > threshold, valid_codes, count, groups)
+
+    # Share of all hours in the group, with or without data
+    if 'gap_mask' in df:
+        gap_mask = df['gap_mask'].to_numpy()
+        hours = np.maximum(result['hours'], 1)
+        result['filled_percentage'] = np.bincount(codes, weights=gap_mask == FILLED, minlength=groups) / hours * 100
+        result['missing_percentage'] = np.bincount(codes, weights=gap_mask == MISSING, minlength=groups) / hours * 100
+
+    return pd.DataFrame(result, index=labels)
+
+def stat_columns(columns=STAT_COLUMNS, quantiles=QUANTILES, ppd_thresholds=PPD_THRESHOLDS, co2_thresholds=CO2_THRESHOLDS):
+    # Every column grouped_stats can return, in its order, so tables of different
+    # sensors can be written under one header
+    names = ['hours']
+    for column in columns:
+        names += [f'{column}_{name}' for name in ['count', 'mean', 'std', 'min', 'max']]
+        names += [f'{column}_q{q * 100:g}' for q in quantiles]
+        if column == 'ppd':
+            names += [f'comfort_percentage_{threshold:g}' for threshold in ppd_thresholds]
+        if column == 'co2':
+            names += [f'high_co2_percentage_{threshold:g}' for threshold in co2_thresholds]
+    return names + ['filled_percentage', 'missing_percentage']
+
+def window_stats(df, **kwargs):
+    # Statistics of the whole frame as one flat Series
+    return grouped_stats(df, None, **kwargs).iloc[0]
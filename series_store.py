@@ -0,0 +1,118 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from comfort_cache import add_comfort_columns, comfort_series
+
+# Binary store for hourly sensor series. Each sensor is one float32 .npy array of
+# shape (columns, hours), so every column is contiguous on disk, plus a JSON header
+# with the first timestamp and the column names. Readers memory-map the array and
+# only copy the rows and hours they ask for.
+
+STORE_COLUMNS = ['temperature', 'humidity', 'co2', 'door', 'ppd']
+HOUR = pd.Timedelta(hours=1)
+
+# Ladybug text files hold 8760 values: one year without February 29th. The store
+# itself keeps leap days and can span any number of years; Ladybug files are only
+# an export format, written one file per calendar year.
+LADYBUG_YEAR = 2024
+
+def series_paths(store_folder, sensor):
+    return os.path.join(store_folder, f'{sensor}.npy'), os.path.join(store_folder, f'{sensor}.json')
+
+def write_series(store_folder, sensor, df):
+    # df must have an hourly DatetimeIndex without gaps
+    os.makedirs(store_folder, exist_ok=True)
+    data_file, header_file = series_paths(store_folder, sensor)
+    np.save(data_file, np.ascontiguousarray(df.to_numpy(dtype=np.float32).T))
+    header = {
+        'sensor': sensor,
+        'start': df.index[0].isoformat(),
+        'freq': 'H',
+        'hours': len(df),
+        'columns': list(df.columns),
+        'dtype': 'float32',
+    }
+    with open(header_file, 'w') as f:
+        json.dump(header, f, indent=2)
+
+def read_header(store_folder, sensor):
+    with open(series_paths(store_folder, sensor)[1], 'r') as f:
+        return json.load(f)
+
+def list_sensors(store_folder, column=None):
+    # Sensors in the store, optionally only those that have the given column
+    if not os.path.exists(store_folder):
+        return []
+    sensors = sorted(f[:-len('.json')] for f in os.listdir(store_folder) if f.endswith('.json'))
+    if column is not None:
+        sensors = [s for s in sensors if column in read_header(store_folder, s)['columns']]
+    return sensors
+
+def has_series(store_folder, sensor):
+    return all(os.path.exists(p) for p in series_paths(store_folder, sensor))
+
+def load_series(store_folder, sensor, columns=None, start=None, end=None):
+    header = read_header(store_folder, sensor)
+    data = np.load(series_paths(store_folder, sensor)[0], mmap_mode='r')
+    first = pd.Timestamp(header['start'])
+
+    begin = 0
+    stop = header['hours']
+    if start is not None:
+        begin = max(0, int(np.ceil((pd.Timestamp(start) - first) / HOUR)))
+    if end is not None:
+        # A date string without a time selects the whole day, like DataFrame slicing
+        last = pd.Timestamp(end)
+        if isinstance(end, str) and ':' not in end:
+            last = last + pd.Timedelta(hours=23)
+        stop = min(stop, int(np.floor((last - first) / HOUR)) + 1)
+    stop = max(stop, begin)
+
+    columns = header['columns'] if columns is None else list(columns)
+    rows = [header['columns'].index(c) for c in columns]
+    values = np.array(data[rows, begin:stop], dtype=np.float64).T
+    index = pd.date_range(start=first + begin * HOUR, periods=stop - begin, freq='H')
+    return pd.DataFrame(values, index=index, columns=columns)
+
+def ladybug_index(year=LADYBUG_YEAR):
+    # Hourly timestamps of a Ladybug year: 8760 hours, February 29th left out
+    hours = pd.date_range(start=f'{year}-01-01', end=f'{year}-12-31 23:00:00', freq='H')
+    return hours[~((hours.month == 2) & (hours.day == 29))]
+
+def to_ladybug_year(df, year):
+    # The 8760 hours of one Ladybug year; hours without data become 0
+    return df.reindex(ladybug_index(year)).fillna(0)
+
+def ladybug_year_files(file_path, index):
+    # Ladybug files for the years an index covers. A series within one year keeps
+    # file_path, longer series get one file per year with the year in the name.
+    years = sorted(set(index.year))
+    if len(years) == 1:
+        return {years[0]: file_path}
+    root, ext = os.path.splitext(file_path)
+    return {year: f'{root}_{year}{ext}' for year in years}
+
+def read_ladybug_file(file_path, year=LADYBUG_YEAR):
+    values = pd.read_csv(file_path, header=None).iloc[:, 0].values
+    return pd.Series(values, index=ladybug_index(year)[:len(values)])
+
+def sensor_files(store_folder, ladybug_folder, sensor):
+    # The files load_sensor_frame reads for this sensor
+    if has_series(store_folder, sensor):
+        return list(series_paths(store_folder, sensor))
+    return [os.path.join(ladybug_folder, f'{sensor}_{kind}_ladybug.txt') for kind in ['temperature', 'humidity', 'co2']]
+
+def load_sensor_frame(store_folder, ladybug_folder, sensor, start=None, end=None, year=LADYBUG_YEAR):
+    # Load a sensor from the binary store, falling back to its Ladybug text files
+    if has_series(store_folder, sensor):
+        return load_series(store_folder, sensor, start=start, end=end)
+
+    files = {kind: os.path.join(ladybug_folder, f'{sensor}_{kind}_ladybug.txt') for kind in ['temperature', 'humidity', 'co2']}
+    if not all(os.path.exists(f) for f in files.values()):
+        raise FileNotFoundError(f"Missing data files for {sensor}")
+    df = pd.DataFrame({kind: read_ladybug_file(f, year) for kind, f in files.items()})
+    # PPD of the whole files, so it shares its comfort cache entry with the scripts
+    # that read the same files without a window
+    add_comfort_columns(df, comfort_series(df['temperature'].values, df['humidity'].values))
+    return df.loc[start:end].copy()
@@ -0,0 +1,207 @@
+import json
+import numpy as np
+import pandas as pd
+from gap_fill import FILLED, MISSING
+from sensor_stats import CO2_THRESHOLDS, PPD_THRESHOLDS, STAT_COLUMNS
+
+# Statistics of many study windows of the same hourly data. The data of a sensor is
+# loaded once and turned into prefix sums of counts, values, squares and threshold
+# exceedances; the sums over any window are then the difference of two rows found
+# with searchsorted, so a window costs the same whatever its length.
+
+def read_windows(file_path):
+    # Study windows from a JSON list of [start, end] pairs or of objects with 'start',
+    # 'end' and an optional 'name'
+    with open(file_path, 'r') as f:
+        entries = json.load(f)
+    windows = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            windows.append((entry.get('name'), entry['start'], entry['end']))
+        else:
+            windows.append((None, entry[0], entry[1]))
+    return windows
+
+def rolling_windows(start_date, end_date, days, step_days=1):
+    # Windows of the given number of days, every step_days days from start to end
+    last_start = pd.Timestamp(end_date) - pd.Timedelta(days=days - 1)
+    starts = pd.date_range(start=start_date, end=last_start, freq=f'{step_days}D')
+    return [(None, start, start + pd.Timedelta(days=days - 1)) for start in starts]
+
+def study_windows(window_pairs=None, windows_file=None, rolling_days=None, start_date=None, end_date=None):
+    # Windows from the command line options as (name, start, end) with start and end
+    # as Timestamps of the first and last day. Unnamed windows are named after their dates.
+    windows = []
+    if windows_file:
+        windows += read_windows(windows_file)
+    windows += [(None, start, end) for start, end in window_pairs or []]
+    if rolling_days:
+        windows += rolling_windows(start_date, end_date, rolling_days)
+
+    result = []
+    for name, start, end in windows:
+        start = pd.Timestamp(start)
+        end = pd.Timestamp(end)
+        if end < start:
+            raise ValueError(f"Window ends before it starts: {start.date()} to {end.date()}")
+        result.append((name or f'{start:%Y-%m-%d}..{end:%Y-%m-%d}', start, end))
+    return result
+
+def prefix_sums(terms):
+    # Cumulative sums of every column of terms with a leading row of zeros, so the
+    # sum over rows i..j-1 is prefix[j] - prefix[i]
+    prefix = np.zeros((len(terms) + 1, terms.shape[1]))
+    np.cumsum(terms, axis=0, out=prefix[1:])
+    return prefix
+
+def window_sums(index, prefix, windows):
+    # Sums over every window, (windows, terms), and the number of hours per window.
+    # Windows include every hour of their last day; index must be sorted.
+    times = index.asi8
+    starts = np.array([start.value for _, start, _ in windows], dtype=np.int64)
+    ends = np.array([(end.normalize() + pd.Timedelta(days=1)).value for _, _, end in windows], dtype=np.int64)
+    first = np.searchsorted(times, starts, side='left')
+    last = np.searchsorted(times, ends, side='left')
+    return prefix[last] - prefix[first], last - first
+
+def sorted_frame(df):
+    if df.index.is_monotonic_increasing:
+        return df
+    return df.sort_index()
+
+def window_table(df, windows, columns=STAT_COLUMNS, ppd_thresholds=PPD_THRESHOLDS, co2_thresholds=CO2_THRESHOLDS):
+    # Count, mean, standard deviation and threshold percentages of every column per
+    # window, with the column names of grouped_stats. Values are centred on the mean
+    # of the whole series first, so the sums of squares keep their precision.
+    df = sorted_frame(df)
+    terms = {}
+    references = {}
+    # Percentage columns and the column whose hours with data they are a share of;
+    # None means a share of all hours
+    percentages = {}
+    for column in columns:
+        if column not in df:
+            continue
+        values = df[column].to_numpy(dtype=float)
+        valid = ~np.isnan(values)
+        references[column] = values[valid].mean() if valid.any() else 0.0
+        centred = np.where(valid, values - references[column], 0)
+        terms[f'{column}_count'] = valid
+        terms[f'{column}_sum'] = centred
+        terms[f'{column}_squares'] = centred * centred
+        if column == 'ppd':
+            for threshold in ppd_thresholds:
+                terms[f'comfort_percentage_{threshold:g}'] = valid & (values <= threshold)
+                percentages[f'comfort_percentage_{threshold:g}'] = column
+        if column == 'co2':
+            for threshold in co2_thresholds:
+                terms[f'high_co2_percentage_{threshold:g}'] = valid & (values > threshold)
+                percentages[f'high_co2_percentage_{threshold:g}'] = column
+    if 'gap_mask' in df:
+        gap_mask = df['gap_mask'].to_numpy()
+        terms['filled_percentage'] = gap_mask == FILLED
+        terms['missing_percentage'] = gap_mask == MISSING
+        percentages['filled_percentage'] = percentages['missing_percentage'] = None
+
+    table = np.column_stack(list(terms.values())).astype(float) if terms else np.zeros((len(df), 0))
+    sums, hours = window_sums(df.index, prefix_sums(table), windows)
+    sums = dict(zip(terms, sums.T))
+
+    result = {
+        'window': [name for name, _, _ in windows],
+        'start': [start for _, start, _ in windows],
+        'end': [end for _, _, end in windows],
+        'hours': hours,
+    }
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for column, reference in references.items():
+            count = sums[f'{column}_count']
+            total = sums[f'{column}_sum']
+            variance = (sums[f'{column}_squares'] - total * total / count) / (count - 1)
+            result[f'{column}_count'] = np.round(count).astype(np.int64)
+            result[f'{column}_mean'] = np.where(count > 0, reference + total / count, np.nan)
+            result[f'{column}_std'] = np.where(count > 1, np.sqrt(np.maximum(variance, 0)), np.nan)
+        for name, column in percentages.items():
+            count = hours if column is None else sums[f'{column}_count']
+            result[name] = np.where(count > 0, sums[name] / count * 100, np.nan)
+    return pd.DataFrame(result)
+
+def window_columns(columns=STAT_COLUMNS, ppd_thresholds=PPD_THRESHOLDS, co2_thresholds=CO2_THRESHOLDS):
+    # Every column window_table can return, in its order
+    names = ['window', 'start', 'end', 'hours']
+    for column in columns:
+        names += [f'{column}_count', f'{column}_mean', f'{column}_std']
+    for column in columns:
+        if column == 'ppd':
+            names += [f'comfort_percentage_{threshold:g}' for threshold in ppd_thresholds]
+        if column == 'co2':
+            names += [f'high_co2_percentage_{threshold:g}' for threshold in co2_thresholds]
+    return names + ['filled_percentage', 'missing_percentage']
+
+def door_window_table(df, windows, variables):
+    # Mean of every variable in open and closed hours, their difference and the
+    # correlation of the variable with door opening per window. Hours without door
+    # data or without a value are left out.
+    df = sorted_frame(df)
+    door = df['door_open'].to_numpy(dtype=float)
+    terms = {}
+    references = {}
+    for variable in variables:
+        values = df[variable].to_numpy(dtype=float)
+        valid = ~np.isnan(values) & ~np.isnan(door)
+        references[variable] = values[valid].mean() if valid.any() else 0.0
+        centred = np.where(valid, values - references[variable], 0)
+        is_open = valid & (door == 1)
+        terms[f'{variable}_count'] = valid
+        terms[f'{variable}_open_count'] = is_open
+        terms[f'{variable}_sum'] = centred
+        terms[f'{variable}_open_sum'] = np.where(is_open, centred, 0)
+        terms[f'{variable}_squares'] = centred * centred
+
+    sums, hours = window_sums(df.index, prefix_sums(np.column_stack(list(terms.values())).astype(float)), windows)
+    sums = dict(zip(terms, sums.T))
+
+    result = {
+        'window': [name for name, _, _ in windows],
+        'start': [start for _, start, _ in windows],
+        'end': [end for _, _, end in windows],
+        'hours': hours,
+    }
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for variable, reference in references.items():
+            # door is 0 or 1, so its sum, its sum of squares and the number of open
+            # hours are the same
+            n = sums[f'{variable}_count']
+            n_open = sums[f'{variable}_open_count']
+            total = sums[f'{variable}_sum']
+            open_sum = sums[f'{variable}_open_sum']
+            open_mean = open_sum / n_open
+            closed_mean = (total - open_sum) / (n - n_open)
+            covariance = n * open_sum - n_open * total
+            variance = (n * n_open - n_open * n_open) * (n * sums[f'{variable}_squares'] - total * total)
+            result[f'{variable}_open_hours'] = np.round(n_open).astype(np.int64)
+            result[f'{variable}_closed_hours'] = np.round(n - n_open).astype(np.int64)
+            result[f'{variable}_door_open'] = np.where(n_open > 0, reference + open_mean, np.nan)
+            result[f'{variable}_door_closed'] = np.where(n > n_open, reference + closed_mean, np.nan)
+            result[f'{variable}_difference'] = open_mean - closed_mean
+            result[f'{variable}_correlation'] = np.clip(covariance / np.sqrt(np.where(variance > 0, variance, np.nan)), -1, 1)
+    return pd.DataFrame(result)
+
+def add_period_arguments(parser, start_date, end_date):
+    # Study period of the scripts that read the store; the defaults are the script's own
+    parser.add_argument('--start-date', default=start_date, help='First day of the study period (YYYY-MM-DD)')
+    parser.add_argument('--end-date', default=end_date, help='Last day of the study period (YYYY-MM-DD)')
+
+def add_window_arguments(parser):
+    parser.add_argument('--window', nargs=2, action='append', metavar=('START', 'END'),
+                        help='Study window from START to END (YYYY-MM-DD, inclusive); may be given several times')
+    parser.add_argument('--windows-file', help='JSON file with a list of study windows')
+    parser.add_argument('--rolling-days', type=int, help='Also use every window of this many days within the study period')
+
+def windows_from_args(args, start_date, end_date):
+    # Windows given on the command line, or an empty list when none were given
+    return study_windows(args.window, args.windows_file, args.rolling_days, start_date, end_date)
+
+def window_params(windows):
+    # Windows as plain values for the manifest
+    return [[name, str(start), str(end)] for name, start, end in windows]